@@ -0,0 +1,480 @@
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest.mock as mock
+sys.modules['prof'] = mock.MagicMock()
+
+import networkx as nx
+import plugin
+import history_processor
+
+
+HISTORY_LINE_RE = re.compile(r'\|.*\|\d\|(from|to)\|N---\|(.*)')
+
+def ReadHistoryMessages(file_name):
+    messages = []
+    with open(file_name, encoding='utf-8') as f:
+        for line in f:
+            m = HISTORY_LINE_RE.search(line)
+            if m:
+                messages.append((m.group(1), m.group(2).replace('\\n', '\n')))
+    return messages
+
+
+# ParseIncomingMessage as it was before the single-pass dispatcher, kept as
+# the reference point for the parse benchmark.
+def LegacyParseIncomingMessage(msg):
+    m = re.search('Current target: (.*)\n'
+                  '.*\n'
+                  'Proxy level: (\\d+)',
+                  msg, re.MULTILINE)
+    if m:
+        target = m.group(1)
+        if target == 'not set':
+            target = None
+        return plugin.StatusParsed(target, int(m.group(2)))
+
+    m = re.search('Node ".*/(.*)" properties:\n'
+                  'Installed program: (#(\\d+)|\\*encrypted\\*)\n'
+                  'Type: (.*)\n',
+                  msg, re.MULTILINE)
+    if m:
+        node = m.group(1)
+        program = None
+        if m.group(3):
+            program = int(m.group(3))
+        node_type = m.group(4)
+        effect = 'NoOp'
+        mm = re.search('Node effect: (.*)\n', msg, re.MULTILINE)
+        if mm:
+            effect = mm.group(1)
+
+        disabled = re.search('DISABLED', msg, re.MULTILINE) is not None
+
+        child_nodes = []
+        mm = re.search('Child nodes:\n(.*)\n\n', msg,
+                       re.MULTILINE and re.DOTALL)
+        if mm:
+            for line in mm.group(1).splitlines():
+                mmm = re.match(
+                    '\\d*: ([a-zA-Z0-9_]*) \\(([a-zA-Z0-9 ]*)\\): (#(\\d*)|\\*encrypted\\*)', line)
+                child_program = None
+                if mmm.group(4):
+                    child_program = int(mmm.group(4))
+                disabled_child = 'DISABLED' in line
+                child_nodes.append(plugin.MakeChildNodeInfo(mmm.group(1), child_program,
+                                                            mmm.group(2), disabled_child))
+
+        return plugin.NodeInfo(node, program, node_type, disabled, effect, child_nodes)
+
+    m = re.search('#(\\d*) progra(m|mm) info:\n'
+                  'Effect: ([a-zA-Z0-9_]*)\n',
+                  msg, re.MULTILINE)
+    if m:
+        program = int(m.group(1))
+        effect = m.group(3)
+        inevitable_effect = None
+        mm = re.search(
+            'Inevitable effect: ([a-zA-Z0-9_]*)\n', msg, re.MULTILINE)
+        if mm:
+            inevitable_effect = mm.group(1)
+        node_types = []
+        mm = re.search('Allowed node types:\n(.*)',
+                       msg, re.MULTILINE and re.DOTALL)
+        if mm:
+            for line in mm.group(1).splitlines():
+                mmm = re.match(' -(.*)', line)
+                if mmm:
+                    node_types.append(mmm.group(1))
+        duration = None
+        mm = re.search('Duration: (\\d*)(sec| sec)', msg, re.MULTILINE)
+        if mm:
+            duration = int(mm.group(1))
+        return plugin.ProgramInfoParsed(program, effect, inevitable_effect, node_types, duration)
+
+    m = re.search('(E|e)xecuting progra(m|mm) #(\\d*).*\n'
+                  '(.*\n)*'
+                  'Node defence: #(\\d*)\n'
+                  '(.*\n)*'
+                  '(A|a)ttack (.*)\n',
+                  msg, re.MULTILINE)
+    if m:
+        return plugin.AttackParsed(int(m.group(3)),  int(m.group(5)), m.group(8) == 'successfull')
+
+    if (msg in ['ok', '403 Forbidden'] or
+        re.search('Info about .* effect:', msg, re.MULTILINE) or
+        re.search('not available(| )\n', msg, re.MULTILINE) or
+        re.search('Error 406: node disabled', msg, re.MULTILINE) or
+            re.search('network scan started: ', msg, re.MULTILINE)):
+        return plugin.DontCareParsed()
+
+    return None
+
+
+def MessagesPerSecond(parse, messages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for msg in messages:
+            parse(msg)
+    return len(messages) * repeat / (time.perf_counter() - start)
+
+# The legacy parser predates disable timers, which are not compared
+def WithoutDisabledFor(parsed):
+    if isinstance(parsed, plugin.NodeInfo):
+        return parsed._replace(disabled_for=None)
+    return parsed
+
+def BenchmarkParse(args):
+    messages = [msg for from_or_to, msg in ReadHistoryMessages(args.history)
+                if from_or_to == 'from']
+    for msg in messages:
+        if LegacyParseIncomingMessage(msg) != WithoutDisabledFor(plugin.ParseIncomingMessage(msg)):
+            print('Parsers disagree on message:\n%s' % msg)
+            return 1
+    before = MessagesPerSecond(LegacyParseIncomingMessage, messages, args.repeat)
+    after = MessagesPerSecond(plugin.ParseIncomingMessage, messages, args.repeat)
+    print('Parsed %d messages x %d' % (len(messages), args.repeat))
+    print('before: %10.0f messages/sec' % before)
+    print('after:  %10.0f messages/sec (x%.2f)' % (after, after / before))
+    return 0
+
+
+NODE_TYPES = ['Firewall', 'Antivirus', 'VPN', 'Brandmauer', 'Router',
+              'Traffic monitor', 'Cyptographic system', 'Data', 'Bank account',
+              'Finance', 'Administrative interface', 'Corporate HQ']
+
+def SyntheticPrograms(count, rng):
+    programs = []
+    for program in rng.sample(range(2, count * 10), count):
+        node_types = rng.sample(NODE_TYPES, rng.randint(1, len(NODE_TYPES)))
+        programs.append(plugin.ProgramInfoParsed(program, 'disable', None, node_types, 600))
+    return programs
+
+def ScanWinningAttacks(programs, defense_program, defense_type):
+    return [p for p in programs
+            if plugin.TheRule(p.program, defense_program) and defense_type in p.node_types]
+
+def LookupsPerSecond(lookup, queries):
+    start = time.perf_counter()
+    for defense_program, defense_type in queries:
+        lookup(defense_program, defense_type)
+    return len(queries) / (time.perf_counter() - start)
+
+def BenchmarkTooltip(args):
+    rng = random.Random(args.seed)
+    for count in args.programs:
+        programs = SyntheticPrograms(count, rng)
+        start = time.perf_counter()
+        index = plugin.AttackIndex(programs)
+        build_time = time.perf_counter() - start
+        queries = [(rng.choice(programs).program * rng.randint(1, 10 ** 5),
+                    rng.choice(NODE_TYPES)) for _ in range(args.queries)]
+        scan = LookupsPerSecond(lambda d, t: ScanWinningAttacks(programs, d, t), queries)
+        # First pass fills the factorization cache, the second one reuses it
+        # with the winning attacks memo cleared, the third answers from the memo
+        cold = LookupsPerSecond(index.WinningAttacks, queries)
+        index.winning_attacks.clear()
+        warm = LookupsPerSecond(index.WinningAttacks, queries)
+        memo = LookupsPerSecond(index.WinningAttacks, queries)
+        print('%d programs (index built in %.3f sec)' % (count, build_time))
+        print('  scan:  %10.0f lookups/sec' % scan)
+        print('  index: %10.0f lookups/sec cold, %10.0f lookups/sec warm' % (cold, warm))
+        print('  memo:  %10.0f lookups/sec' % memo)
+    return 0
+
+
+def SyntheticNetwork(count, rng):
+    node_infos = []
+    names = ['node0']
+    parent = 0
+    while len(names) < count:
+        childs = []
+        for _ in range(min(rng.randint(2, 4), count - len(names))):
+            name = 'node%d' % len(names)
+            names.append(name)
+            program = rng.choice([None, rng.randint(10 ** 5, 10 ** 8)])
+            childs.append(plugin.MakeChildNodeInfo(
+                name, program, rng.choice(NODE_TYPES), rng.random() < 0.3))
+        node_infos.append(plugin.NodeInfo(
+            names[parent], rng.randint(10 ** 5, 10 ** 8), rng.choice(NODE_TYPES),
+            rng.random() < 0.3, rng.choice(['NoOp', 'NoOp', 'trace']), childs))
+        parent += 1
+    return node_infos
+
+# Graph as networkx attribute dicts, the way PerSystemProcessor stored it
+# before the compact node store, including render attributes.
+def NetworkxGraph(node_infos):
+    graph = nx.DiGraph()
+    def AddOrUpdateNode(node_info):
+        graph.add_node(node_info.node)
+        node = graph.nodes[node_info.node]
+        if node_info.program:
+            node['program'] = node_info.program
+        if node_info.childs == [] and node_info.disabled:
+            node['leaf'] = True
+        node['disabled'] = node_info.disabled
+        if node_info.node_effect:
+            node['effect'] = node_info.node_effect
+    for node_info in node_infos:
+        AddOrUpdateNode(node_info)
+        for child in node_info.childs:
+            AddOrUpdateNode(child)
+            graph.add_edge(node_info.node, child.node)
+    processor = plugin.PerSystemProcessor()
+    for name, node in graph.nodes.items():
+        record = plugin.NodeFromAttributes(node)
+        node['label'] = processor.NodeLabel(name, record)
+        node['style'] = '"' + processor.NodeStyle(record) + '"'
+    return graph
+
+def BenchmarkDot(args):
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as output:
+        for count in args.nodes:
+            node_infos = SyntheticNetwork(count, rng)
+            graph = NetworkxGraph(node_infos)
+            processor = plugin.PerSystemProcessor()
+            for node_info in node_infos:
+                processor.OnNodeInfo(node_info)
+            start = time.perf_counter()
+            plugin.nx_pydot.write_dot(graph, os.path.join(output, 'pydot.dot'))
+            pydot_time = time.perf_counter() - start
+            start = time.perf_counter()
+            with open(os.path.join(output, 'direct.dot'), 'w') as f:
+                processor.WriteDot(f)
+            direct_time = time.perf_counter() - start
+            print('%d nodes: pydot %.3f sec, direct %.3f sec (x%.1f)' %
+                  (count, pydot_time, direct_time, pydot_time / direct_time))
+    return 0
+
+def AllocatedBytes(build):
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    result = build()
+    allocated = sum(stat.size_diff for stat in
+                    tracemalloc.take_snapshot().compare_to(start, 'filename'))
+    tracemalloc.stop()
+    return result, allocated
+
+def BenchmarkMemory(args):
+    rng = random.Random(args.seed)
+    for count in args.nodes:
+        node_infos = SyntheticNetwork(count, rng)
+        # Node names in messages are fresh strings, copy them so both
+        # representations pay for their own names
+        node_infos = [node_info._replace(
+            node=''.join(node_info.node),
+            childs=[child._replace(node=''.join(child.node)) for child in node_info.childs])
+            for node_info in node_infos]
+        _, networkx_bytes = AllocatedBytes(lambda: NetworkxGraph(node_infos))
+        def BuildProcessor():
+            processor = plugin.PerSystemProcessor()
+            for node_info in node_infos:
+                processor.OnNodeInfo(node_info)
+            return processor
+        _, compact_bytes = AllocatedBytes(BuildProcessor)
+        print('%d nodes: networkx %.1f MB, compact %.1f MB (x%.1f)' %
+              (count, networkx_bytes / 2 ** 20, compact_bytes / 2 ** 20,
+               networkx_bytes / compact_bytes))
+    return 0
+
+
+BOT_JID = 'darknet@cyberspace'
+PERCENTILES = [50, 90, 99]
+
+# Systems named in the history, so copies of it can use other names
+def HistorySystems(events):
+    shards, _ = history_processor.ShardBySystem(events, {'events': 0, 'skipped': 0})
+    return list(shards.keys())
+
+# History repeated scale times. With systems set, every repetition attacks
+# its own copies of the systems, so the number of systems grows too.
+def ScaledHistory(events, scale, systems=False):
+    if not systems:
+        return events * scale
+    names = HistorySystems(events)
+    name_re = re.compile(r'\b(%s)\b' % '|'.join(map(re.escape, names)))
+    scaled = []
+    for copy in range(scale):
+        rename = lambda m: '%s_%d' % (m.group(1), copy)
+        scaled.extend((direction, name_re.sub(rename, message)) for direction, message in events)
+    return scaled
+
+def ResetPluginState(output):
+    plugin.OUTPUT_LOCATION = os.path.join(output, '')
+    plugin.sessions.clear()
+    plugin.processors = plugin.ProcessorCache()
+    plugin.active_session = None
+    plugin.known_programs = dict()
+    plugin.attack_index = plugin.AttackIndex()
+    plugin.attack_outcomes = plugin.AttackOutcomes(plugin.OutcomesFileName())
+    plugin.programs_journal_records = 0
+    plugin.Divisors.cache_clear()
+
+def MessageType(direction, message):
+    if direction == 'to':
+        return 'Send'
+    parsed = plugin.ParseIncomingMessage(message)
+    return type(parsed).__name__ if parsed is not None else 'Unparsed'
+
+# Wraps a plugin function so every call adds its duration to timings
+def Timed(name, timings):
+    function = getattr(plugin, name)
+    def Wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings.append(time.perf_counter() - start)
+    return mock.patch.object(plugin, name, Wrapper)
+
+def Percentiles(samples):
+    samples = sorted(samples)
+    result = {'count': len(samples)}
+    for p in PERCENTILES:
+        result['p%d' % p] = samples[int(round(p / 100 * (len(samples) - 1)))] * 1e6
+    result['max'] = samples[-1] * 1e6
+    return result
+
+def ReplayScenario(events):
+    latencies = dict()
+    tooltips = []
+    journal = []
+    types = [MessageType(direction, message) for direction, message in events]
+    # Recording every logging call on the prof mock would cost more than
+    # handling the message
+    with tempfile.TemporaryDirectory() as output, \
+         mock.patch.object(plugin.prof, 'log_info', lambda message: None), \
+         mock.patch.object(plugin.prof, 'log_warning', lambda message: None), \
+         mock.patch.object(plugin, 'render_scheduler'), \
+         mock.patch.object(plugin.PerSystemProcessor, 'PrintToPdf', return_value=0), \
+         Timed('MakeHackTooltip', tooltips), Timed('SaveKnownProgram', journal):
+        ResetPluginState(output)
+        start = time.perf_counter()
+        for (direction, message), message_type in zip(events, types):
+            message_start = time.perf_counter()
+            if direction == 'from':
+                plugin.prof_pre_chat_message_display_no_print(BOT_JID, '', message)
+            else:
+                plugin.prof_pre_chat_message_send(BOT_JID, message)
+            latencies.setdefault(message_type, []).append(time.perf_counter() - message_start)
+        replay_time = time.perf_counter() - start
+        start = time.perf_counter()
+        plugin.prof_on_shutdown()
+        shutdown_time = time.perf_counter() - start
+        systems = len(plugin.processors)
+    metrics = {message_type: Percentiles(samples)
+               for message_type, samples in sorted(latencies.items())}
+    if tooltips:
+        metrics['tooltip'] = Percentiles(tooltips)
+    if journal:
+        metrics['journal'] = Percentiles(journal)
+    return {
+        'events': len(events),
+        'systems': systems,
+        'events_per_sec': len(events) / replay_time,
+        'shutdown_ms': shutdown_time * 1e3,
+        'latency_us': metrics,
+    }
+
+# Latencies which grew by more than threshold over the baseline, only
+# percentiles with enough samples to be stable are compared
+def Regressions(results, baseline, threshold, min_samples=100):
+    regressions = []
+    for scenario, result in results.items():
+        baseline_metrics = baseline.get(scenario, {}).get('latency_us', {})
+        for metric, values in result['latency_us'].items():
+            baseline_values = baseline_metrics.get(metric, None)
+            if baseline_values is None or values['count'] < min_samples:
+                continue
+            for p in ['p50', 'p90']:
+                if values[p] > baseline_values[p] * (1 + threshold):
+                    regressions.append('%s %s %s: %.1f us, baseline %.1f us' %
+                                       (scenario, metric, p, values[p], baseline_values[p]))
+    return regressions
+
+def BenchmarkReplay(args):
+    events = list(history_processor.ReadHistory(args.history))
+    scenarios = [('x%d' % scale, scale, ScaledHistory(events, scale)) for scale in args.scales]
+    if args.systems:
+        scenarios.append(('systems_x%d' % args.systems, args.systems,
+                          ScaledHistory(events, args.systems, systems=True)))
+    results = dict()
+    for name, scale, scenario_events in scenarios:
+        results[name] = result = ReplayScenario(scenario_events)
+        print('%s: %d events, %d systems, %.0f events/sec, shutdown %.1f ms' %
+              (name, result['events'], result['systems'], result['events_per_sec'],
+               result['shutdown_ms']))
+        for metric, values in result['latency_us'].items():
+            print('  %-16s %8d calls  p50 %8.1f  p90 %8.1f  p99 %8.1f  max %8.1f us' %
+                  (metric, values['count'], values['p50'], values['p90'], values['p99'],
+                   values['max']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline and os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            # Short replays are dominated by warm up and timer noise
+            gated = {name: results[name] for name, scale, _ in scenarios
+                     if scale >= args.gate_scale}
+            regressions = Regressions(gated, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+        print('No regressions against %s' % args.baseline)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parse = subparsers.add_parser('parse', help='ParseIncomingMessage throughput')
+    parse.add_argument('--history', default='example.history')
+    parse.add_argument('--repeat', type=int, default=20)
+    parse.set_defaults(run=BenchmarkParse)
+
+    tooltip = subparsers.add_parser('tooltip', help='MakeHackTooltip lookups')
+    tooltip.add_argument('--programs', type=int, nargs='+', default=[10000, 100000])
+    tooltip.add_argument('--queries', type=int, default=200)
+    tooltip.add_argument('--seed', type=int, default=0)
+    tooltip.set_defaults(run=BenchmarkTooltip)
+
+    dot = subparsers.add_parser('dot', help='.dot file writing')
+    dot.add_argument('--nodes', type=int, nargs='+', default=[1000, 10000])
+    dot.add_argument('--seed', type=int, default=0)
+    dot.set_defaults(run=BenchmarkDot)
+
+    memory = subparsers.add_parser('memory', help='graph memory footprint')
+    memory.add_argument('--nodes', type=int, nargs='+', default=[10000])
+    memory.add_argument('--seed', type=int, default=0)
+    memory.set_defaults(run=BenchmarkMemory)
+
+    replay = subparsers.add_parser('replay', help='message hooks replaying a history')
+    replay.add_argument('--history', default='example.history')
+    replay.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+    replay.add_argument('--systems', type=int, default=50,
+                        help='also replay this many copies of the history, each with '
+                             'its own systems (0 to skip)')
+    replay.add_argument('--output', help='write results as json')
+    replay.add_argument('--baseline', default='benchmark_baseline.json',
+                        help='results to compare against, fails on regressions')
+    replay.add_argument('--threshold', type=float, default=0.5,
+                        help='allowed latency growth over the baseline, 0.5 is 50%%')
+    replay.add_argument('--gate-scale', type=int, default=10,
+                        help='only compare scenarios repeating the history this many '
+                             'times or more against the baseline')
+    replay.set_defaults(run=BenchmarkReplay)
+
+    args = parser.parse_args()
+    return args.run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
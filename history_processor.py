@@ -1,21 +1,162 @@
+import argparse
+import multiprocessing
+import os
 import re
-import unittest.mock as mock
 import sys
+import time
+import unittest.mock as mock
+from collections import OrderedDict
 sys.modules['prof'] = mock.MagicMock()
 
 import plugin
 
-plugin.prof_init(None, None, None, None)
 
-if True: 
-    with open('example.history', encoding='utf-8') as f:
+BOT_JID = 'darknet@cyberspace'
+RECORD_RE = re.compile(r'\|[^|]*\|\d+\|(from|to)\|[^|]*\|(.*)')
+ESCAPE_RE = re.compile(r'\\(.)')
+ESCAPES = {'n': '\n', '\\': '\\'}
+
+
+def Unescape(text):
+    return ESCAPE_RE.sub(lambda m: ESCAPES.get(m.group(1), m.group(0)), text)
+
+# Yields (direction, message) pairs. Lines which do not start a new record
+# continue the message of the previous one.
+def ReadHistory(file_name):
+    direction = None
+    lines = []
+    with open(file_name, encoding='utf-8', errors='replace') as f:
         for line in f:
-            m = re.search('\|.*\|\d\|(from|to)\|N---\|(.*)', line)
-            from_or_to = m.group(1)
-            msg = m.group(2).replace('\\n', '\n')
-            if (from_or_to == 'from'):
-                plugin.prof_pre_chat_message_display_no_print('darknet@cyberspace', '', msg)
-            else:
-                plugin.prof_pre_chat_message_send('darknet@cyberspace', msg)
-
-plugin.PrintAllPdfs()
+            line = line.rstrip('\n')
+            m = RECORD_RE.match(line)
+            if m:
+                if direction:
+                    yield direction, Unescape('\n'.join(lines))
+                direction = m.group(1)
+                lines = [m.group(2)]
+            elif direction:
+                lines.append(line)
+    if direction:
+        yield direction, Unescape('\n'.join(lines))
+
+def HistoryFiles(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in sorted(os.walk(path)):
+                for file_name in sorted(files):
+                    yield os.path.join(root, file_name)
+        else:
+            yield path
+
+
+# Splits the conversation into per-system event lists, following target
+# switches the same way the plugin does. Messages mentioning other systems
+# go to their lists too. Program info is not tied to a
+# system, so it is returned separately.
+def ShardBySystem(events, stats):
+    shards = OrderedDict()
+    programs = []
+    current_system = None
+    last_command = ''
+    for direction, message in events:
+        stats['events'] += 1
+        if direction == 'to':
+            last_command = message
+        elif message == 'ok':
+            m = plugin.TARGET_COMMAND_RE.search(last_command)
+            if m:
+                current_system = m.group(1)
+        elif 'Current target: ' in message:
+            status = plugin.ParseStatus(message)
+            if status:
+                current_system = status.target
+        elif ' info:\n' in message:
+            program_info = plugin.ParseProgramInfo(message)
+            if program_info:
+                programs.append(program_info)
+                continue
+        # Passively mapped facts may be about systems other than the target
+        systems = set(fact.system for fact in plugin.ExtractFacts(message)
+                      if not isinstance(fact, plugin.SystemTraced))
+        if current_system:
+            systems.add(current_system)
+        for system in sorted(systems):
+            shards.setdefault(system, []).append((direction, message))
+        if not systems:
+            stats['skipped'] += 1
+    return shards, programs
+
+def ReplayShard(task):
+    system, events, output_location, render = task
+    plugin.OUTPUT_LOCATION = output_location
+    plugin.sessions.clear()
+    plugin.processors = plugin.ProcessorCache()
+    session = plugin.GetSession(BOT_JID)
+    start = time.perf_counter()
+    for direction, message in events:
+        session.current_system = system
+        if direction == 'from':
+            plugin.prof_pre_chat_message_display_no_print(BOT_JID, '', message)
+        else:
+            plugin.prof_pre_chat_message_send(BOT_JID, message)
+    session.current_system = system
+    processor = session.GetCurrentProcessor()
+    replay_time = time.perf_counter() - start
+    start = time.perf_counter()
+    if render:
+        processor.PrintToPdf(system)
+    processor.SaveSnapshot(system)
+    return system, len(events), replay_time, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replays Profanity history files into the plugin output.')
+    parser.add_argument('paths', nargs='*', default=['example.history'],
+                        help='history files or chatlog directories')
+    parser.add_argument('--output', default=plugin.OUTPUT_LOCATION)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--no-render', dest='render', action='store_false')
+    args = parser.parse_args()
+
+    plugin.OUTPUT_LOCATION = os.path.join(args.output, '')
+    plugin.prof_init(None, None, None, None)
+    stats = {'files': 0, 'bytes': 0, 'events': 0, 'skipped': 0}
+
+    start = time.perf_counter()
+    shards = OrderedDict()
+    programs = []
+    for file_name in HistoryFiles(args.paths):
+        stats['files'] += 1
+        stats['bytes'] += os.path.getsize(file_name)
+        file_shards, file_programs = ShardBySystem(ReadHistory(file_name), stats)
+        for system, events in file_shards.items():
+            shards.setdefault(system, []).extend(events)
+        programs.extend(file_programs)
+    for program_info in programs:
+        plugin.LearnProgram(program_info)
+    read_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tasks = [(system, events, plugin.OUTPUT_LOCATION, args.render)
+             for system, events in shards.items()]
+    if args.jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(args.jobs, len(tasks))) as pool:
+            results = list(pool.imap_unordered(ReplayShard, tasks))
+    else:
+        results = [ReplayShard(task) for task in tasks]
+    replay_time = time.perf_counter() - start
+
+    for system, events, system_replay_time, render_time in sorted(results):
+        print('%-20s %6d events, replay %.3f sec, render %.3f sec' %
+              (system, events, system_replay_time, render_time))
+    print('%d files, %d bytes, %d events (%d outside of any system), %d programs' %
+          (stats['files'], stats['bytes'], stats['events'], stats['skipped'], len(programs)))
+    print('read and shard: %.3f sec, %.0f events/sec' %
+          (read_time, stats['events'] / max(read_time, 1e-9)))
+    print('replay and render of %d systems with %d jobs: %.3f sec' %
+          (len(tasks), args.jobs, replay_time))
+    print('total: %.0f events/sec' % (stats['events'] / max(read_time + replay_time, 1e-9)))
+
+if __name__ == '__main__':
+    main()
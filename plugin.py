@@ -1,24 +1,174 @@
-from collections import namedtuple
+from collections import namedtuple, deque, OrderedDict
+import asyncio
 import re
 import os
-import networkx as nx
+import sys
 import networkx.drawing.nx_pydot as nx_pydot
 from subprocess import call
 import prof
 import glob
+import hashlib
+import heapq
+import itertools
 import json
+import pickle
+import shlex
+import sqlite3
+import threading
+import time
+import cProfile
+import io
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 
 
 StatusParsed = namedtuple('StatusParsed', ['target', 'proxy_level'])
 NodeInfo = namedtuple('NodeInfo', [
-                      'node', 'program', 'node_type', 'disabled', 'node_effect', 'childs'])
+                      'node', 'program', 'node_type', 'disabled', 'node_effect', 'childs',
+                      'disabled_for'], defaults=[None])
 ProgramInfoParsed = namedtuple('ProgramInfoParsed', [
                                'program', 'effect', 'inevitable_effect', 'node_types', 'duration'])
 AttackParsed = namedtuple(
     'AttackParsed', ['attack_program', 'defense_program', 'success'])
 DontCareParsed = namedtuple('DontCareParsed', [])
+PlanStep = namedtuple('PlanStep', ['node', 'attack_program'])
+AttackTask = namedtuple('AttackTask', ['node', 'attack_program', 'depends_on'])
+RenderResult = namedtuple('RenderResult', ['system', 'status', 'seconds', 'error'])
+AttackOutcome = namedtuple('AttackOutcome', [
+                           'attack_program', 'defense_program', 'node_type', 'success'])
+# Facts passively extracted from bot messages, each names the system it is about
+NodeAttacked = namedtuple('NodeAttacked', ['system', 'node', 'defense_program', 'disabled_for'])
+NodeUnavailable = namedtuple('NodeUnavailable', ['system', 'node'])
+SystemFound = namedtuple('SystemFound', ['system', 'firewall_program'])
+SystemTraced = namedtuple('SystemTraced', ['system', 'proxy_decrease'])
 
 OUTPUT_LOCATION = '/home/aeremin/Dev/deus-jabber-plugin/output/'
+# SQLite file shared by the team, programs and map updates are exchanged
+# through it every TEAM_SYNC_INTERVAL seconds. None disables sharing.
+TEAM_STORE_LOCATION = None
+TEAM_SYNC_INTERVAL = 5
+# Bumped whenever the layout of per-system graph snapshots changes
+SNAPSHOT_VERSION = 2
+# Number of system graphs kept in memory, least recently used ones are
+# saved and dropped beyond that
+MAX_LOADED_SYSTEMS = 32
+# Graphviz output used for rendered maps, svg is much cheaper to produce
+# and good enough for live viewing
+RENDER_FORMAT = 'pdf'
+RENDER_FORMATS = {'pdf': '-Tpdf:cairo', 'svg': '-Tsvg'}
+POINTS_PER_INCH = 72
+# Autoattack sends at most one command per AUTOATTACK_MIN_INTERVAL seconds,
+# keeps up to AUTOATTACK_MAX_IN_FLIGHT attacks unanswered and gives up on
+# an attack after AUTOATTACK_TIMEOUT seconds without reply
+AUTOATTACK_MIN_INTERVAL = 1.0
+AUTOATTACK_MAX_IN_FLIGHT = 3
+AUTOATTACK_TIMEOUT = 30.0
+# /crawl keeps up to CRAWL_WINDOW look and info queries unanswered, sends
+# at most one per CRAWL_MIN_INTERVAL seconds and gives up on a query after
+# CRAWL_TIMEOUT seconds without reply
+CRAWL_WINDOW = 4
+CRAWL_MIN_INTERVAL = 0.5
+CRAWL_TIMEOUT = 30.0
+# Both are pumped every PUMP_INTERVAL seconds (whole seconds, the client
+# has no finer timers), sending all commands which came due meanwhile
+PUMP_INTERVAL = 1
+# Minimal delay (in seconds) between two consecutive renders of the same system
+RENDER_MIN_INTERVAL = 2.0
+# Number of journaled programs after which programs.json is rewritten
+PROGRAMS_JOURNAL_MAX_RECORDS = 100
+# Smaller node type buckets are scanned directly instead of enumerating
+# divisors of the defense program
+DIVISOR_LOOKUP_MIN_PROGRAMS = 64
+# Instrumentation keeps the last STATS_WINDOW timings of every hot path
+# function and writes them to the log every STATS_LOG_INTERVAL seconds
+STATS_WINDOW = 1000
+STATS_LOG_INTERVAL = 300
+STATS_PROFILE_LINES = 25
+# Number of pairs /outcomes lists where TheRule disagrees with attacks seen
+OUTCOMES_REPORT_PAIRS = 10
+OUTCOMES_FLUSH_INTERVAL = 1
+
+
+# Call counters and rolling timing windows of instrumented functions.
+# Disabled instrumentation costs one attribute check per call.
+class Stats:
+    def __init__(self, window=STATS_WINDOW):
+        self.enabled = False
+        self.window = window
+        self.lock = threading.Lock()
+        self.profiler = None
+        self.profile_messages = 0
+        self.Reset()
+
+    def Reset(self):
+        with self.lock:
+            self.counts = dict()
+            self.totals = dict()
+            self.samples = dict()
+
+    def Record(self, name, seconds):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+            samples = self.samples.get(name, None)
+            if samples is None:
+                samples = self.samples[name] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def Format(self):
+        with self.lock:
+            lines = []
+            for name in sorted(self.counts):
+                samples = sorted(self.samples[name])
+                percentiles = [samples[(len(samples) - 1) * p // 100] * 1e6 for p in [50, 90, 99]]
+                lines.append('%s: %d calls, %.1f ms total, last %d: p50 %.0f us, p90 %.0f us, '
+                             'p99 %.0f us, max %.0f us' %
+                             ((name, self.counts[name], self.totals[name] * 1e3, len(samples)) +
+                              tuple(percentiles) + (samples[-1] * 1e6,)))
+            return lines
+
+    def StartProfile(self, messages):
+        self.profiler = cProfile.Profile()
+        self.profile_messages = messages
+
+    # Runs the handler of one message, under cProfile while a profile is
+    # being captured
+    def Profiled(self, function, *args):
+        if self.profiler is None:
+            return function(*args)
+        self.profiler.enable()
+        try:
+            return function(*args)
+        finally:
+            self.profiler.disable()
+            self.profile_messages -= 1
+            if self.profile_messages <= 0:
+                self.ReportProfile()
+
+    def ReportProfile(self):
+        report = io.StringIO()
+        pstats.Stats(self.profiler, stream=report).sort_stats('cumulative').print_stats(
+            STATS_PROFILE_LINES)
+        self.profiler = None
+        prof.log_info(report.getvalue())
+        prof.cons_show('Profile written to the log')
+
+stats = Stats()
+
+def Instrumented(name):
+    def Decorate(function):
+        @wraps(function)
+        def Wrapper(*args, **kwargs):
+            if not stats.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.Record(name, time.perf_counter() - start)
+        return Wrapper
+    return Decorate
 
 def IsCyberSpaceBot(jid):
     return jid == 'darknet@cyberspace' or jid == 'raven@jabber.alice.digital'
@@ -26,266 +176,2189 @@ def IsCyberSpaceBot(jid):
 def MakeChildNodeInfo(node, program, node_type, disabled):
     return NodeInfo(node, program, node_type, disabled, None, None)
 
-# TODO: Change to actual rule
+# TODO: Change to actual rule, /outcomes tells how often it is wrong
 def TheRule(attack_program, defense_program):
     return (defense_program is not None and
         (defense_program % int(attack_program)) == 0)
 
+def Factorize(n):
+    factors = []
+    d = 2
+    while d * d <= n:
+        while n % d == 0:
+            factors.append(d)
+            n //= d
+        d += 1 if d == 2 else 2
+    if n > 1:
+        factors.append(n)
+    return tuple(factors)
 
-def ParseIncomingMessage(msg):
-    m = re.search('Current target: (.*)\n'
-                  '.*\n'
-                  'Proxy level: (\d+)',
-                  msg, re.MULTILINE)
-    if m:
-        target = m.group(1)
-        if target == 'not set':
-            target = None
-        return StatusParsed(target, int(m.group(2)))
-
-    m = re.search('Node ".*/(.*)" properties:\n'
-                  'Installed program: (#(\d+)|\*encrypted\*)\n'
-                  'Type: (.*)\n',
-                  msg, re.MULTILINE)
-    if m:
-        node = m.group(1)
-        program = None
-        if m.group(3):
-            program = int(m.group(3))
-        node_type = m.group(4)
-        effect = 'NoOp'
-        mm = re.search('Node effect: (.*)\n', msg, re.MULTILINE)
-        if mm:
-            effect = mm.group(1)
-
-        disabled = re.search('DISABLED', msg, re.MULTILINE) is not None
-
-        child_nodes = []
-        mm = re.search('Child nodes:\n(.*)\n\n', msg,
-                       re.MULTILINE and re.DOTALL)
-        if mm:
-            for line in mm.group(1).splitlines():
-                mmm = re.match(
-                    '\d*: ([a-zA-Z0-9_]*) \(([a-zA-Z0-9 ]*)\): (#(\d*)|\*encrypted\*)', line)
-                child_program = None
-                if mmm.group(4):
-                    child_program = int(mmm.group(4))
-                disabled_child = 'DISABLED' in line
-                child_nodes.append(MakeChildNodeInfo(mmm.group(1), child_program,
-                                                     mmm.group(2), disabled_child))
-
-        return NodeInfo(node, program, node_type, disabled, effect, child_nodes)
-
-    m = re.search('#(\d*) progra(m|mm) info:\n'
-                  'Effect: ([a-zA-Z0-9_]*)\n',
-                  msg, re.MULTILINE)
-    if m:
-        program = int(m.group(1))
-        effect = m.group(3)
-        inevitable_effect = None
-        mm = re.search(
-            'Inevitable effect: ([a-zA-Z0-9_]*)\n', msg, re.MULTILINE)
-        if mm:
-            inevitable_effect = mm.group(1)
-        node_types = []
-        mm = re.search('Allowed node types:\n(.*)',
-                       msg, re.MULTILINE and re.DOTALL)
-        if mm:
-            for line in mm.group(1).splitlines():
-                mmm = re.match(' -(.*)', line)
-                if mmm:
-                    node_types.append(mmm.group(1))
-        duration = None
-        mm = re.search('Duration: (\d*)(sec| sec)', msg, re.MULTILINE)
-        if mm:
-            duration = int(mm.group(1))
-        return ProgramInfoParsed(program, effect, inevitable_effect, node_types, duration)
-
-    m = re.search('(E|e)xecuting progra(m|mm) #(\d*).*\n'
-                  '(.*\n)*'
-                  'Node defence: #(\d*)\n'
-                  '(.*\n)*'
-                  '(A|a)ttack (.*)\n',
-                  msg, re.MULTILINE)
-    if m:
-        return AttackParsed(int(m.group(3)),  int(m.group(5)), m.group(8) == 'successfull')
-
-    if (msg in ['ok', '403 Forbidden'] or
-        re.search('Info about .* effect:', msg, re.MULTILINE) or
-        re.search('not available(| )\n', msg, re.MULTILINE) or
-        re.search('Error 406: node disabled', msg, re.MULTILINE) or
-            re.search('network scan started: ', msg, re.MULTILINE)):
+@lru_cache(maxsize=4096)
+def Divisors(n):
+    factors = Factorize(n)
+    divisors = [1]
+    for p in set(factors):
+        divisors = [d * p ** e for d in divisors for e in range(factors.count(p) + 1)]
+    return tuple(sorted(divisors))
+
+
+STATUS_RE = re.compile(r'Current target: (.*)\n'
+                       r'.*\n'
+                       r'Proxy level: (\d+)')
+NODE_RE = re.compile(r'Node ".*/(.*)" properties:\n'
+                     r'Installed program: (#(\d+)|\*encrypted\*)\n'
+                     r'Type: (.*)\n')
+NODE_EFFECT_RE = re.compile(r'Node effect: (.*)\n')
+DISABLED_FOR_RE = re.compile(r'DISABLED for: (\d+) sec')
+CHILD_NODES_RE = re.compile(r'Child nodes:\n(.*)\n\n', re.DOTALL)
+CHILD_NODE_RE = re.compile(
+    r'\d*: ([a-zA-Z0-9_]*) \(([a-zA-Z0-9 ]*)\): (#(\d*)|\*encrypted\*)')
+PROGRAM_RE = re.compile(r'#(\d*) progra(m|mm) info:\n'
+                        r'Effect: ([a-zA-Z0-9_]*)\n')
+INEVITABLE_EFFECT_RE = re.compile(r'Inevitable effect: ([a-zA-Z0-9_]*)\n')
+NODE_TYPES_RE = re.compile(r'Allowed node types:\n(.*)', re.DOTALL)
+NODE_TYPE_RE = re.compile(r' -(.*)')
+DURATION_RE = re.compile(r'Duration: (\d*)(sec| sec)')
+ATTACK_START_RE = re.compile(r'[Ee]xecuting progra(?:m|mm) #(\d+)')
+ATTACK_DEFENCE_RE = re.compile(r'Node defence: #(\d+)$')
+ATTACK_RESULT_RE = re.compile(r'[Aa]ttack (.*)')
+DONT_CARE_RE = re.compile(r'Info about .* effect:|'
+                          r'not available(| )\n|'
+                          r'Error 406: node disabled|'
+                          r'network scan started: ')
+DONT_CARE_MESSAGES = frozenset(['ok', '403 Forbidden'])
+TARGET_COMMAND_RE = re.compile(r'target ([a-zA-Z0-9_]*)')
+ATTACK_COMMAND_RE = re.compile(r'#(\d+) ([a-zA-Z0-9_]+)')
+NODE_SYSTEM_RE = re.compile(r'Node "([^"/]*)/')
+ATTACK_TARGET_RE = re.compile(r' target:(\S+)')
+NODE_DISABLED_RE = re.compile(r"^Node '?([^' ]+)'? disabled for (\d+) seconds", re.MULTILINE)
+NODE_DATA_RE = re.compile(r'^Data in [^/\n]*/(\S+):$', re.MULTILINE)
+NODE_UNAVAILABLE_RE = re.compile(r'^([^/\s]+)/(\S+) not available', re.MULTILINE)
+SCANNED_SYSTEM_RE = re.compile(r'^(\S+) +\(firewall: #(\d+) \)', re.MULTILINE)
+PROXY_DECREASED_RE = re.compile(r'Proxy level decreased by (\d+)')
+SECURITY_LOG_RE = re.compile(r'^(\S+) security log updated', re.MULTILINE)
+INCORRECT_PROGRAM_RE = re.compile(r'^incorrect program #?(\d+)', re.MULTILINE)
+DOT_ID_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|-?(\.[0-9]+|[0-9]+(\.[0-9]*)?)')
+DOT_KEYWORDS = frozenset(['node', 'edge', 'graph', 'digraph', 'subgraph', 'strict'])
+
+def ParseStatus(msg):
+    m = STATUS_RE.search(msg)
+    if not m:
+        return None
+    target = m.group(1)
+    if target == 'not set':
+        target = None
+    return StatusParsed(target, int(m.group(2)))
+
+def ParseNodeInfo(msg):
+    m = NODE_RE.search(msg)
+    if not m:
+        return None
+    node = m.group(1)
+    program = None
+    if m.group(3):
+        program = int(m.group(3))
+    node_type = m.group(4)
+    effect = 'NoOp'
+    mm = NODE_EFFECT_RE.search(msg)
+    if mm:
+        effect = mm.group(1)
+
+    disabled = 'DISABLED' in msg
+    disabled_for = None
+    mm = DISABLED_FOR_RE.search(msg)
+    if mm:
+        disabled_for = int(mm.group(1))
+
+    child_nodes = []
+    mm = CHILD_NODES_RE.search(msg)
+    if mm:
+        for line in mm.group(1).splitlines():
+            mmm = CHILD_NODE_RE.match(line)
+            child_program = None
+            if mmm.group(4):
+                child_program = int(mmm.group(4))
+            disabled_child = 'DISABLED' in line
+            child_nodes.append(MakeChildNodeInfo(mmm.group(1), child_program,
+                                                 mmm.group(2), disabled_child))
+
+    return NodeInfo(node, program, node_type, disabled, effect, child_nodes, disabled_for)
+
+def ParseProgramInfo(msg):
+    m = PROGRAM_RE.search(msg)
+    if not m:
+        return None
+    program = int(m.group(1))
+    effect = m.group(3)
+    inevitable_effect = None
+    mm = INEVITABLE_EFFECT_RE.search(msg)
+    if mm:
+        inevitable_effect = mm.group(1)
+    node_types = []
+    mm = NODE_TYPES_RE.search(msg)
+    if mm:
+        for line in mm.group(1).splitlines():
+            mmm = NODE_TYPE_RE.match(line)
+            if mmm:
+                node_types.append(mmm.group(1))
+    duration = None
+    mm = DURATION_RE.search(msg)
+    if mm:
+        duration = int(mm.group(1))
+    return ProgramInfoParsed(program, effect, inevitable_effect, node_types, duration)
+
+# Scans the message line by line, so arbitrary long traces between the
+# 'executing' line, the defence line and the result line cost O(n).
+# Picks the last defence line which is followed by a result line and the
+# last result line, only lines terminated by a newline are considered.
+def ParseAttack(msg):
+    lines = msg.split('\n')
+    attack_program = None
+    defense_candidate = None
+    defense_program = None
+    success = None
+    for line in lines[:-1]:
+        if attack_program is None:
+            m = ATTACK_START_RE.search(line)
+            if m:
+                attack_program = int(m.group(1))
+            continue
+        m = ATTACK_DEFENCE_RE.match(line)
+        if m:
+            defense_candidate = int(m.group(1))
+            continue
+        if defense_candidate is not None:
+            m = ATTACK_RESULT_RE.match(line)
+            if m:
+                defense_program = defense_candidate
+                success = m.group(1) == 'successfull'
+    if defense_program is None:
+        return None
+    return AttackParsed(attack_program, defense_program, success)
+
+def ParseDontCare(msg):
+    if DONT_CARE_RE.search(msg):
         return DontCareParsed()
+    return None
 
+# Every parser needs one of its markers to be present in the message, so
+# cheap substring checks decide which parsers are worth running at all.
+# In order of priority.
+MESSAGE_PARSERS = [
+    (('Current target: ',), ParseStatus),
+    (('Node "',), ParseNodeInfo),
+    ((' info:\n',), ParseProgramInfo),
+    (('xecuting progra',), ParseAttack),
+    (('Info about ', 'not available', 'Error 406: node disabled',
+      'network scan started: '), ParseDontCare),
+]
+
+@Instrumented('parse')
+def ParseIncomingMessage(msg):
+    if msg in DONT_CARE_MESSAGES:
+        return DontCareParsed()
+    for markers, parser in MESSAGE_PARSERS:
+        for marker in markers:
+            if marker in msg:
+                parsed = parser(msg)
+                if parsed is not None:
+                    return parsed
+                break
     return None
 
 
+# Passive extractors, each yields facts found in a message no matter which
+# system is the current target or which command was sent last.
+def ExtractAttackedNodes(msg):
+    m = ATTACK_TARGET_RE.search(msg)
+    attack = ParseAttack(msg)
+    if not m or not attack or not attack.success:
+        return
+    for mm in NODE_DISABLED_RE.finditer(msg):
+        yield NodeAttacked(m.group(1), mm.group(1), attack.defense_program, int(mm.group(2)))
+    for mm in NODE_DATA_RE.finditer(msg):
+        yield NodeAttacked(m.group(1), mm.group(1), attack.defense_program, None)
+
+def ExtractUnavailableNodes(msg):
+    for m in NODE_UNAVAILABLE_RE.finditer(msg):
+        yield NodeUnavailable(m.group(1), m.group(2))
+
+def ExtractScannedSystems(msg):
+    for m in SCANNED_SYSTEM_RE.finditer(msg):
+        yield SystemFound(m.group(1), int(m.group(2)))
+
+def ExtractTraces(msg):
+    proxy_decrease = sum(int(m.group(1)) for m in PROXY_DECREASED_RE.finditer(msg))
+    for m in SECURITY_LOG_RE.finditer(msg):
+        yield SystemTraced(m.group(1), proxy_decrease)
+        proxy_decrease = 0
+
+# Same marker scheme as MESSAGE_PARSERS, but every matching extractor runs.
+# Messages without any marker, which are most of them, cost a few substring
+# checks.
+MESSAGE_EXTRACTORS = [
+    ((' disabled for ', 'Data in '), ExtractAttackedNodes),
+    (('not available',), ExtractUnavailableNodes),
+    (('Systems found:',), ExtractScannedSystems),
+    (('security log updated',), ExtractTraces),
+]
+
+def ExtractFacts(msg):
+    for markers, extractor in MESSAGE_EXTRACTORS:
+        for marker in markers:
+            if marker in msg:
+                yield from extractor(msg)
+                break
+
+
+# Fields are only ever appended, so older snapshots keep loading
+class Node:
+    __slots__ = ['program', 'disabled', 'leaf', 'effect', 'node_type', 'disabled_until']
+
+    def __init__(self, program=None, disabled=False, leaf=False, effect=None,
+                 node_type=None, disabled_until=None):
+        self.program = program
+        self.disabled = disabled
+        self.leaf = leaf
+        self.effect = effect
+        self.node_type = node_type
+        # time.time() at which the node gets enabled again, None when unknown
+        self.disabled_until = disabled_until
+
+    def Fields(self):
+        return (self.program, self.disabled, self.leaf, self.effect, self.node_type,
+                self.disabled_until)
+
+    def IsDisabled(self, now):
+        return self.disabled and (self.disabled_until is None or self.disabled_until > now)
+
+    def Attributes(self):
+        attributes = []
+        if self.program is not None:
+            attributes.append(('program', self.program))
+        if self.leaf:
+            attributes.append(('leaf', True))
+        attributes.append(('disabled', self.disabled))
+        if self.effect is not None:
+            attributes.append(('effect', self.effect))
+        if self.node_type is not None:
+            attributes.append(('node_type', self.node_type))
+        if self.disabled_until is not None:
+            attributes.append(('disabled_until', self.disabled_until))
+        return attributes
+
+
+# Accepts both typed values and the strings read back from .dot files
+def NodeFromAttributes(attributes):
+    program = attributes.get('program', None)
+    effect = attributes.get('effect', None)
+    node_type = attributes.get('node_type', None)
+    disabled_until = attributes.get('disabled_until', None)
+    return Node(int(program) if program else None,
+                attributes.get('disabled', False) in (True, 'True'),
+                attributes.get('leaf', False) in (True, 'True'),
+                effect.strip('"') if effect else None,
+                node_type.strip('"') if node_type else None,
+                float(disabled_until) if disabled_until else None)
+
+
+# Directed graph of a system: node records keyed by interned node names
+# and child lists, which are only allocated for nodes having children.
+class SystemGraph:
+    def __init__(self):
+        self.nodes = dict()
+        self.childs = dict()
+        # Entry nodes, computed on demand by Roots
+        self.roots = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, name):
+        return name in self.nodes
+
+    def AddNode(self, name):
+        node = self.nodes.get(name, None)
+        if node is None:
+            node = Node()
+            self.nodes[sys.intern(name)] = node
+            self.roots = None
+        return node
+
+    def AddEdge(self, source, target):
+        self.AddNode(source)
+        self.AddNode(target)
+        childs = self.childs.get(source, None)
+        if childs is None:
+            childs = []
+            self.childs[sys.intern(source)] = childs
+        if target not in childs:
+            childs.append(sys.intern(target))
+            self.roots = None
+
+    def Childs(self, name):
+        return self.childs.get(name, ())
+
+    # Nodes a system is entered through: its firewall, or when that is not
+    # known yet the nodes nobody points to. Nodes only seen in attack replies
+    # or team updates have no known parent but are not entries.
+    def Roots(self):
+        if self.roots is None:
+            if 'firewall' in self.nodes:
+                self.roots = ['firewall']
+            else:
+                targets = set(target for _, target in self.Edges())
+                self.roots = [name for name in self.nodes if name not in targets]
+        return self.roots
+
+    def Edges(self):
+        for source, childs in self.childs.items():
+            for target in childs:
+                yield source, target
+
+    def Copy(self):
+        graph = SystemGraph()
+        graph.nodes = {name: Node(*node.Fields()) for name, node in self.nodes.items()}
+        graph.childs = {name: list(childs) for name, childs in self.childs.items()}
+        return graph
+
+
 class PerSystemProcessor:
-    def __init__(self, graph=None):
-        self.graph = graph or nx.DiGraph()
-        for _, node in self.graph.node.items():
-            node['disabled'] = node.get('disabled', '') == 'True'
-            p = node.get('program', None)
-            if p: node['program'] = int(p)
-        
+    def __init__(self, graph=None, positions=None, stamps=None):
+        self.graph = graph if graph is not None else SystemGraph()
+        # Node name -> (x, y) in inches, as laid out by the last render
+        self.positions = positions if positions is not None else dict()
+        # Node name -> (fields, time they were last changed). Nodes saved
+        # without stamps are older than anything teammates share.
+        if stamps is None:
+            stamps = {name: (node.Fields(), 0.0) for name, node in self.graph.nodes.items()}
+        self.stamps = stamps
+        # Min-heap of (disabled_until, node name), entries of nodes enabled
+        # or disabled again since are skipped when popped
+        self.expiries = [(node.disabled_until, name) for name, node in self.graph.nodes.items()
+                         if node.disabled and node.disabled_until is not None]
+        heapq.heapify(self.expiries)
+
+    @Instrumented('node_info')
     def OnNodeInfo(self, node_info):
         self.AddOrUpdateNode(node_info)
         for child in node_info.childs:
             self.AddOrUpdateNode(child)
-            self.graph.add_edge(node_info.node, child.node)
+            self.graph.AddEdge(node_info.node, child.node)
 
     def AddOrUpdateNode(self, node_info):
-        if not self.graph.has_node(node_info.node):
-            self.graph.add_node(node_info.node)
-        node = self.graph.node[node_info.node]
+        node = self.graph.AddNode(node_info.node)
         self.MaybeSaveNodeProgram(node_info.node, node_info.program)
         if node_info.childs == [] and node_info.disabled:
-            node['leaf'] = True
-        node['disabled'] = node_info.disabled
+            node.leaf = True
+        elif node_info.childs:
+            node.leaf = False
+        if node_info.disabled_for is not None:
+            self.DisableFor(node_info.node, node_info.disabled_for)
+        elif not node_info.disabled:
+            node.disabled_until = None
+        node.disabled = node_info.disabled
         if node_info.node_effect:
-            node['effect'] = node_info.node_effect
+            node.effect = node_info.node_effect
+        if node_info.node_type:
+            node.node_type = node_info.node_type
 
     def OnAttackParsed(self, attack_parsed, target):
+        self.graph.AddNode(target)
         self.MaybeSaveNodeProgram(target, attack_parsed.defense_program)
 
+    def OnNodeAttacked(self, fact):
+        self.graph.AddNode(fact.node)
+        self.MaybeSaveNodeProgram(fact.node, fact.defense_program)
+        if fact.disabled_for:
+            self.DisableFor(fact.node, fact.disabled_for)
+
+    # A node can only be looked at through a disabled parent, so none of
+    # the parents of an unavailable node is disabled (any more).
+    def OnNodeUnavailable(self, fact):
+        if fact.node not in self.graph:
+            return
+        for parent, childs in self.graph.childs.items():
+            if fact.node in childs:
+                self.graph.nodes[parent].disabled = False
+                self.graph.nodes[parent].disabled_until = None
+
+    # Applies a node a teammate changed at updated, unless the node here is
+    # fresher. Returns whether it was applied.
+    def OnTeamNode(self, name, fields, updated):
+        node = self.graph.nodes.get(name, None)
+        if node is not None:
+            stamp = self.stamps.get(name, None)
+            # Not stamped yet means changed here since the last push
+            if stamp is None or stamp[0] != node.Fields() or stamp[1] >= updated:
+                return False
+        node = self.graph.AddNode(name)
+        # Older plugins share fewer fields
+        for slot, value in zip(Node.__slots__, fields):
+            setattr(node, slot, value)
+        if node.disabled and node.disabled_until is not None:
+            heapq.heappush(self.expiries, (node.disabled_until, name))
+        self.stamps[name] = (node.Fields(), updated)
+        return True
+
+    # Stamps nodes changed since the last call with now. Returns (name,
+    # fields, updated) of the changed nodes, or of all nodes with all_nodes.
+    def StampChanges(self, now, all_nodes=False):
+        changes = []
+        for name, node in self.graph.nodes.items():
+            fields = node.Fields()
+            stamp = self.stamps.get(name, None)
+            if stamp is None or stamp[0] != fields:
+                stamp = self.stamps[name] = (fields, now)
+            elif not all_nodes:
+                continue
+            changes.append((name,) + stamp)
+        return changes
+
+    def DisableFor(self, name, seconds, now=None):
+        node = self.graph.nodes[name]
+        node.disabled = True
+        node.disabled_until = (time.time() if now is None else now) + seconds
+        heapq.heappush(self.expiries, (node.disabled_until, name))
+
+    # Enables nodes whose disable timer ran out, returns their names
+    def ExpireDisabled(self, now):
+        expired = []
+        while self.expiries and self.expiries[0][0] <= now:
+            disabled_until, name = heapq.heappop(self.expiries)
+            node = self.graph.nodes.get(name, None)
+            if node is not None and node.disabled and node.disabled_until == disabled_until:
+                node.disabled = False
+                node.disabled_until = None
+                expired.append(name)
+        return expired
+
+    # Nodes which can be looked at right now: the entry nodes and children
+    # of reachable disabled nodes. Only touches the reachable part and its
+    # border, not the whole graph.
+    def ReachableNodes(self, now=None):
+        now = time.time() if now is None else now
+        reachable = list(self.graph.Roots())
+        seen = set(reachable)
+        queue = deque(reachable)
+        while queue:
+            name = queue.popleft()
+            if not self.graph.nodes[name].IsDisabled(now):
+                continue
+            for child in self.graph.Childs(name):
+                if child not in seen:
+                    seen.add(child)
+                    reachable.append(child)
+                    queue.append(child)
+        return reachable
+
+    def OnSystemFound(self, fact):
+        node = self.graph.AddNode('firewall')
+        self.MaybeSaveNodeProgram('firewall', fact.firewall_program)
+        if node.node_type is None:
+            node.node_type = 'Firewall'
+
     def MaybeSaveNodeProgram(self, node_name, program):
         if not program:
             return
-        node = self.graph.node[node_name]
-        node['program'] = program
+        self.graph.nodes[node_name].program = program
 
-    def UpdateNodeLabel(self, name, node):
-        if 'program' not in node.keys():
+    def NodeLabel(self, name, node):
+        if node.program is None:
             program_str = '???'
         else:
-            program_str = str(node['program'])
-        label = name + '\n' + str(program_str)
-        node['label'] = label
-
-    def PrintToPdf(self, name):
-        for node_name, node in self.graph.node.items():
-            self.UpdateNodeLabel(node_name, node)
-            styles = ''
-            if node.get('leaf', False):
-                styles += 'diagonals,'
-            if node.get('disabled', False):
-                styles += 'dotted,'
-            effect = node.get('effect', 'NoOp')
-            if not effect == 'NoOp':
-                styles += 'bold,'
-            if styles:
-                styles = styles[:-1]
-            node['style'] = '"' + styles + '"'
-
-        dot_file_name = '%sdot/%s.dot' % (OUTPUT_LOCATION, name)
-        pdf_file_name = '%s%s.pdf' % (OUTPUT_LOCATION, name)
-        nx_pydot.write_dot(self.graph, dot_file_name)
-        call(['dot', dot_file_name, '-Tpdf:cairo', '-o%s' % pdf_file_name])
-
-
-last_command = ''
-proxy_level = None
-current_system = None
-processors = dict()
+            program_str = str(node.program)
+        return name + '\n' + program_str
+
+    def NodeStyle(self, node):
+        styles = []
+        if node.leaf:
+            styles.append('diagonals')
+        if node.disabled:
+            styles.append('dotted')
+        if node.effect and not node.effect == 'NoOp':
+            styles.append('bold')
+        return ','.join(styles)
+
+    # Stored node attributes are written too, so the .dot file can still be
+    # loaded back when there is no snapshot.
+    # Laid out nodes are pinned to their positions, scaled from inches to
+    # the units of the graphviz pass reading the file.
+    def WriteDot(self, f, pin_scale=None):
+        f.write('strict digraph {\n')
+        for node_name, node in self.graph.nodes.items():
+            attributes = node.Attributes()
+            attributes.append(('label', self.NodeLabel(node_name, node)))
+            attributes.append(('style', self.NodeStyle(node)))
+            position = self.positions.get(node_name, None) if pin_scale else None
+            if position is not None:
+                attributes.append(('pos', '%.2f,%.2f!' % (position[0] * pin_scale,
+                                                          position[1] * pin_scale)))
+            f.write('%s [%s];\n' % (DotId(node_name),
+                                     ', '.join('%s=%s' % (k, DotId(v)) for k, v in attributes)))
+        for source, target in self.graph.Edges():
+            f.write('%s -> %s;\n' % (DotId(source), DotId(target)))
+        f.write('}\n')
+
+    # Nodes keep their positions between renders: only nodes which were not
+    # laid out yet are placed, then neato -n2 draws everything where it is.
+    @Instrumented('render')
+    def PrintToPdf(self, name, output_format=None):
+        output_format = output_format or RENDER_FORMAT
+        dot_file_name = DotFileName(name)
+        content_hash = self.ContentHash()
+        result = self.UpdateLayout(name)
+        if result != 0:
+            return result
+        laid_out = all(node_name in self.positions for node_name in self.graph.nodes)
+        with open(dot_file_name, 'w') as f:
+            self.WriteDot(f, POINTS_PER_INCH if laid_out else None)
+        command = ['neato' if laid_out else 'dot', dot_file_name, RENDER_FORMATS[output_format],
+                   '-o%s' % RenderFileName(name, output_format)]
+        if laid_out:
+            command.append('-n2')
+        result = call(command)
+        if result == 0:
+            with open(RenderedHashFileName(name), 'w') as f:
+                f.write(content_hash)
+        return result
+
+    # The first layout is done by dot, later ones by neato with already
+    # placed nodes pinned, so only new nodes are positioned.
+    def UpdateLayout(self, name):
+        if all(node_name in self.positions for node_name in self.graph.nodes):
+            return 0
+        dot_file_name = DotFileName(name)
+        with open(dot_file_name, 'w') as f:
+            self.WriteDot(f, 1.0)
+        result = call(['neato' if self.positions else 'dot', dot_file_name, '-Tplain',
+                       '-o%s' % LayoutFileName(name)])
+        if result != 0:
+            return result
+        if os.path.isfile(LayoutFileName(name)):
+            with open(LayoutFileName(name)) as f:
+                self.positions.update(ReadLayout(f))
+        return 0
+
+    def ContentHash(self):
+        nodes = sorted((node_name, node.Fields())
+                       for node_name, node in self.graph.nodes.items())
+        edges = sorted(self.graph.Edges())
+        return hashlib.sha1(repr((nodes, edges)).encode('utf-8')).hexdigest()
+
+    # A copy to render, without the stamps rendering does not need
+    def Snapshot(self):
+        return PerSystemProcessor(self.graph.Copy(), dict(self.positions), dict())
+
+    # What SaveSnapshot writes. Shares nothing with the processor, so it can
+    # be taken under processors_lock and written after releasing it.
+    def SnapshotData(self, name):
+        return {
+            'version': SNAPSHOT_VERSION,
+            'seq': next(snapshot_seq),
+            'dot': FileStamp(DotFileName(name)),
+            'nodes': [(node_name,) + node.Fields() for node_name, node in self.graph.nodes.items()],
+            'edges': list(self.graph.Edges()),
+            'positions': dict(self.positions),
+            'stamps': dict(self.stamps),
+        }
+
+    def SaveSnapshot(self, name):
+        WriteSnapshot(name, self.SnapshotData(name))
+
+
+# Warnings of the render thread and workers, the client may only be called
+# on its own thread so WarningsTick logs them
+queued_warnings = deque()
+
+def LogWarning(message):
+    if threading.current_thread() is threading.main_thread():
+        prof.log_warning(message)
+    else:
+        queued_warnings.append(message)
+
+def WarningsTick():
+    while queued_warnings:
+        prof.log_warning(queued_warnings.popleft())
+
+# Orders snapshots taken of the same system, written_snapshots keeps the
+# newest one written per file so an older one never replaces it
+snapshot_seq = itertools.count()
+written_snapshots = dict()
+snapshot_lock = threading.Lock()
+
+@Instrumented('save_snapshot')
+def WriteSnapshot(name, snapshot):
+    snapshot_file_name = SnapshotFileName(name)
+    os.makedirs(os.path.dirname(snapshot_file_name), exist_ok=True)
+    # Writers in other threads or processes never share a temporary file
+    tmp_file_name = '%s.%d.%d.tmp' % (snapshot_file_name, os.getpid(), threading.get_ident())
+    with open(tmp_file_name, 'wb') as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    with snapshot_lock:
+        if snapshot['seq'] < written_snapshots.get(snapshot_file_name, -1):
+            os.remove(tmp_file_name)
+            return
+        os.replace(tmp_file_name, snapshot_file_name)
+        written_snapshots[snapshot_file_name] = snapshot['seq']
+
+
+def DotFileName(name):
+    return '%sdot/%s.dot' % (OUTPUT_LOCATION, name)
+
+def RenderFileName(name, output_format=None):
+    return '%s%s.%s' % (OUTPUT_LOCATION, name, output_format or RENDER_FORMAT)
+
+def LayoutFileName(name):
+    return '%sdot/%s.plain' % (OUTPUT_LOCATION, name)
+
+# Node positions from graphviz -Tplain output, in inches
+def ReadLayout(f):
+    positions = dict()
+    for line in f:
+        if line.startswith('node '):
+            fields = shlex.split(line)
+            positions[sys.intern(fields[1])] = (float(fields[2]), float(fields[3]))
+    return positions
+
+def DotId(value):
+    value = str(value)
+    if DOT_ID_RE.fullmatch(value) and value.lower() not in DOT_KEYWORDS:
+        return value
+    return '"' + value.replace('"', '\\"').replace('\n', '\\n') + '"'
+
+# Content hash of the graph the current PDF was rendered from
+def RenderedHashFileName(name):
+    return '%sdot/%s.sha1' % (OUTPUT_LOCATION, name)
+
+def SnapshotFileName(name):
+    return '%ssnapshot/%s.pickle' % (OUTPUT_LOCATION, name)
+
+def FileStamp(file_name):
+    try:
+        stat = os.stat(file_name)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def ReadSnapshot(name):
+    try:
+        with open(SnapshotFileName(name), 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        LogWarning('Ignoring broken snapshot of %s: %s' % (name, e))
+        return None
+    if snapshot.get('version', None) not in (1, SNAPSHOT_VERSION):
+        return None
+    return snapshot
+
+def GraphFromSnapshot(snapshot):
+    graph = SystemGraph()
+    for name, *fields in snapshot['nodes']:
+        if snapshot['version'] == 1:
+            # Networkx attribute dicts
+            graph.nodes[sys.intern(name)] = NodeFromAttributes(fields[0])
+        else:
+            graph.nodes[sys.intern(name)] = Node(*fields)
+    for source, target in snapshot['edges']:
+        graph.AddEdge(source, target)
+    return graph
+
+def GraphFromDot(file_name):
+    graph = SystemGraph()
+    dot_graph = nx_pydot.read_dot(file_name)
+    for name, attributes in dot_graph.nodes.items():
+        graph.nodes[sys.intern(name)] = NodeFromAttributes(attributes)
+    for source, target in dot_graph.edges():
+        graph.AddEdge(source, target)
+    return graph
+
+# Snapshots are only trusted while the .dot file they were saved next to
+# is unchanged, otherwise the .dot file is parsed and a new snapshot saved.
+# Systems with neither file usable start empty.
+def LoadProcessor(name):
+    snapshot = ReadSnapshot(name)
+    dot_stamp = FileStamp(DotFileName(name))
+    if snapshot and (dot_stamp is None or snapshot['dot'] == dot_stamp):
+        return PerSystemProcessor(GraphFromSnapshot(snapshot), snapshot.get('positions', None),
+                                  snapshot.get('stamps', None))
+    if dot_stamp is None:
+        LogWarning('No usable snapshot or .dot file of %s, starting it empty' % name)
+        return PerSystemProcessor()
+    processor = PerSystemProcessor(GraphFromDot(DotFileName(name)))
+    processor.SaveSnapshot(name)
+    return processor
+
+def SavedSystems():
+    saved_files = (glob.glob(DotFileName('*')) + glob.glob(SnapshotFileName('*')))
+    return sorted(set(os.path.basename(os.path.splitext(f)[0]) for f in saved_files))
+
+
+# Maps system names to processors. Knows every saved system but only loads
+# them on first access, keeping at most max_loaded of them in memory.
+class ProcessorCache:
+    def __init__(self, systems=(), max_loaded=None):
+        self.systems = set(systems)
+        self.loaded = OrderedDict()
+        self.max_loaded = max_loaded or MAX_LOADED_SYSTEMS
+
+    def __contains__(self, name):
+        return name in self.systems
+
+    def __len__(self):
+        return len(self.systems)
+
+    def __getitem__(self, name):
+        processor = self.loaded.get(name, None)
+        if processor is not None:
+            self.loaded.move_to_end(name)
+            return processor
+        if name not in self.systems:
+            raise KeyError(name)
+        processor = LoadProcessor(name)
+        self.loaded[name] = processor
+        self.EvictRarelyUsed()
+        return processor
+
+    def __setitem__(self, name, processor):
+        self.systems.add(name)
+        self.loaded[name] = processor
+        self.loaded.move_to_end(name)
+        self.EvictRarelyUsed()
+
+    def get(self, name, default=None):
+        if name not in self.systems:
+            return default
+        return self[name]
+
+    def keys(self):
+        return sorted(self.systems)
+
+    def items(self):
+        for name in self.keys():
+            yield name, self[name]
+
+    def EvictRarelyUsed(self):
+        while len(self.loaded) > self.max_loaded:
+            name, processor = self.loaded.popitem(last=False)
+            processor.SaveSnapshot(name)
+
+    def SaveLoaded(self):
+        for name, processor in self.loaded.items():
+            processor.SaveSnapshot(name)
+
+
+# Renders systems in a background thread, so message hooks never wait for
+# graphviz. Repeated MarkDirty calls for the same system are merged into a
+# single render of the latest graph state.
+class RenderScheduler:
+    def __init__(self, render, min_interval=RENDER_MIN_INTERVAL):
+        self.render = render
+        self.min_interval = min_interval
+        self.condition = threading.Condition()
+        self.dirty = dict()
+        self.last_render = dict()
+        self.rendering = 0
+        self.flushing = False
+        self.stopped = False
+        self.thread = None
+
+    def MarkDirty(self, name):
+        with self.condition:
+            self.dirty[name] = True
+            if self.thread is None:
+                self.stopped = False
+                self.thread = threading.Thread(target=self._Run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def Flush(self):
+        with self.condition:
+            self.flushing = True
+            self.condition.notify_all()
+            while (self.dirty or self.rendering) and self.thread is not None:
+                self.condition.wait()
+            self.flushing = False
+
+    def Stop(self):
+        self.Flush()
+        with self.condition:
+            self.stopped = True
+            thread, self.thread = self.thread, None
+            self.condition.notify_all()
+        if thread is not None:
+            thread.join()
+
+    def _NextReady(self):
+        now = time.monotonic()
+        soonest = None
+        for name in self.dirty:
+            ready_at = self.last_render.get(name, float('-inf')) + self.min_interval
+            if self.flushing or ready_at <= now:
+                return name, 0
+            if soonest is None or ready_at < soonest:
+                soonest = ready_at
+        return None, soonest - now
+
+    def _Run(self):
+        while True:
+            with self.condition:
+                while not self.dirty and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                name, delay = self._NextReady()
+                if name is None:
+                    self.condition.wait(delay)
+                    continue
+                del self.dirty[name]
+                self.rendering += 1
+            try:
+                self.render(name)
+            except Exception as e:
+                LogWarning('Failed to render %s: %s' % (name, e))
+            finally:
+                with self.condition:
+                    self.last_render[name] = time.monotonic()
+                    self.rendering -= 1
+                    self.condition.notify_all()
+
+
+# Known programs bucketed by allowed node type, so finding attacks against
+# a node only touches programs which divide its defense program.
+class AttackIndex:
+    def __init__(self, programs=()):
+        self.programs = dict()
+        self.by_node_type = dict()
+        self.node_types = dict()
+        # Attack program -> defense programs it was seen executed against
+        self.observed_defenses = dict()
+        # (defense program, node type) -> winning attacks, valid until the
+        # next change of the index, which increments version
+        self.winning_attacks = dict()
+        self.version = 0
+        # Shared by all sessions, lookups are much more frequent than changes
+        self.lock = threading.RLock()
+        for program_info in programs:
+            self.Add(program_info)
+
+    def Add(self, program_info):
+        with self.lock:
+            self.Remove(program_info.program)
+            node_types = frozenset(program_info.node_types)
+            self.programs[program_info.program] = program_info
+            self.node_types[program_info.program] = node_types
+            for node_type in node_types:
+                self.by_node_type.setdefault(node_type, dict())[program_info.program] = program_info
+
+    def Remove(self, program):
+        with self.lock:
+            self.winning_attacks.clear()
+            self.programs.pop(program, None)
+            self.version += 1
+            for node_type in self.node_types.pop(program, ()):
+                bucket = self.by_node_type[node_type]
+                del bucket[program]
+                if not bucket:
+                    del self.by_node_type[node_type]
+
+    def WinningAttacks(self, defense_program, defense_type):
+        key = (defense_program, defense_type)
+        winning_attacks = self.winning_attacks.get(key, None)
+        if winning_attacks is None:
+            with self.lock:
+                winning_attacks = self.FindWinningAttacks(defense_program, defense_type)
+                self.winning_attacks[key] = winning_attacks
+        return winning_attacks
+
+    def FindWinningAttacks(self, defense_program, defense_type):
+        return self.AttacksAgainst(defense_program, self.by_node_type.get(defense_type, {}))
+
+    def AttacksAgainst(self, defense_program, bucket=None):
+        with self.lock:
+            if bucket is None:
+                bucket = self.programs
+            if defense_program is None or not bucket:
+                return ()
+            if defense_program <= 0 or len(bucket) < DIVISOR_LOOKUP_MIN_PROGRAMS:
+                candidates = bucket.keys()
+            else:
+                candidates = [d for d in Divisors(defense_program) if d in bucket]
+            return tuple(bucket[k] for k in sorted(candidates) if TheRule(k, defense_program))
+
+    def AddObservedDefense(self, attack_program, defense_program):
+        with self.lock:
+            self.observed_defenses.setdefault(attack_program, set()).add(defense_program)
+
+    def ObservedDefenses(self, attack_program):
+        with self.lock:
+            return sorted(self.observed_defenses.get(attack_program, ()))
+
+
+# Outcomes of every attack seen, appended to a journal every
+# OUTCOMES_FLUSH_INTERVAL seconds, off the message hooks. The last outcome
+# of an (attack, defense) pair is trusted over TheRule.
+class AttackOutcomes:
+    NOTHING_VERIFIED = dict()
+
+    def __init__(self, file_name=None):
+        self.records = 0
+        # Defense program -> {attack program: success}, the inner dicts are
+        # replaced rather than changed, so tooltips read them without locking
+        self.verified = dict()
+        # (attack program, defense program) -> node type of the last outcome
+        self.node_types = dict()
+        # Defense program -> sorted (attack program, node type) last seen
+        # winning
+        self.verified_winning = dict()
+        # Records and pairs for which TheRule predicted something else
+        self.disagreements = 0
+        self.disagreeing_pairs = dict()
+        self.lock = threading.RLock()
+        if file_name and os.path.isfile(file_name):
+            with open(file_name) as f:
+                for line in f:
+                    try:
+                        outcome = AttackOutcome(*json.loads(line))
+                    except (ValueError, TypeError):
+                        # Torn write of the last record
+                        prof.log_warning('Skipping broken attack outcome record: %s' % line)
+                        continue
+                    self.Add(outcome)
+        # Opened only while flushing, so nothing is left open
+        self.file_name = file_name
+        self.unsaved = []
+
+    def Add(self, outcome):
+        with self.lock:
+            self.records += 1
+            defense_program = outcome.defense_program
+            pair = (outcome.attack_program, defense_program)
+            attacks = self.verified.get(defense_program, {})
+            if (attacks.get(outcome.attack_program, None) != outcome.success or
+                    self.node_types.get(pair, None) != outcome.node_type):
+                attacks = dict(attacks)
+                attacks[outcome.attack_program] = outcome.success
+                self.node_types[pair] = outcome.node_type
+                # Set first, so whoever sees the new attacks sees these too
+                self.verified_winning[defense_program] = tuple(sorted(
+                    (attack, self.node_types[(attack, defense_program)])
+                    for attack, success in attacks.items() if success))
+                self.verified[defense_program] = attacks
+            if TheRule(*pair) != outcome.success:
+                self.disagreements += 1
+                self.disagreeing_pairs[pair] = outcome.success
+            else:
+                self.disagreeing_pairs.pop(pair, None)
+
+    def Record(self, outcome):
+        with self.lock:
+            self.Add(outcome)
+            if self.file_name:
+                self.unsaved.append(outcome)
+
+    @Instrumented('save_outcomes')
+    def Flush(self):
+        with self.lock:
+            if not self.unsaved:
+                return
+            with open(self.file_name, 'a') as f:
+                f.write(''.join(json.dumps(outcome) + '\n' for outcome in self.unsaved))
+            self.unsaved = []
+
+    # Attack program -> success of the last attack against defense_program
+    def Verified(self, defense_program):
+        return self.verified.get(defense_program, self.NOTHING_VERIFIED)
+
+    def VerifiedWinning(self, defense_program):
+        return self.verified_winning.get(defense_program, ())
+
+    def Close(self):
+        with self.lock:
+            if self.file_name:
+                self.Flush()
+                self.file_name = None
+
+
+# Attacked nodes by attack program, in the order commands were sent. The
+# bot answers in order, so a reply for program N belongs to the oldest
+# pending attack with program N, and attacks sent before that one were
+# answered already even if their replies were not recognized.
+class PendingAttacks:
+    def __init__(self):
+        self.nodes = dict()
+        self.sent = 0
+
+    def Add(self, attack_program, node):
+        self.sent += 1
+        self.nodes.setdefault(attack_program, deque()).append((self.sent, node))
+
+    def Pop(self, attack_program):
+        nodes = self.nodes.get(attack_program, None)
+        if not nodes:
+            return None
+        sent, node = nodes.popleft()
+        for program in list(self.nodes.keys()):
+            nodes = self.nodes[program]
+            while nodes and nodes[0][0] < sent:
+                nodes.popleft()
+            if not nodes:
+                del self.nodes[program]
+        return node
+
+    def Discard(self, attack_program, node):
+        nodes = self.nodes.get(attack_program, None)
+        if not nodes:
+            return
+        remaining = deque(entry for entry in nodes if entry[1] != node)
+        if remaining:
+            self.nodes[attack_program] = remaining
+        else:
+            del self.nodes[attack_program]
+
+
+# When the next command may be sent after one sent now, next_send being
+# when that one was due. Commands due since the previous pump are sent in
+# one go, but the time before it does not add up to a burst.
+def NextSendTime(next_send, now, min_interval):
+    oldest_due = now - max(PUMP_INTERVAL - min_interval, 0)
+    return max(now if next_send is None else next_send, oldest_due) + min_interval
+
+# Sends attacks of queued plans. An attack is sent once the previous attack
+# of its plan succeeded, no attack on the same node or with the same program
+# is unanswered and the rate limit allows it.
+class AutoAttacker:
+    def __init__(self, send, min_interval=None, max_in_flight=None, timeout=None,
+                 clock=time.monotonic, pending_attacks=None):
+        self.send = send
+        # Commands sent by the session, so attacks given up on are forgotten
+        self.pending_attacks = pending_attacks if pending_attacks is not None else PendingAttacks()
+        self.min_interval = AUTOATTACK_MIN_INTERVAL if min_interval is None else min_interval
+        self.max_in_flight = max_in_flight or AUTOATTACK_MAX_IN_FLIGHT
+        self.timeout = timeout or AUTOATTACK_TIMEOUT
+        self.clock = clock
+        self.queue = OrderedDict()
+        self.in_flight = dict()
+        self.done = set()
+        self.next_send = None
+
+    def IsIdle(self):
+        return not self.queue and not self.in_flight
+
+    def Add(self, plan):
+        if self.IsIdle():
+            # Disabled nodes recover after a while, don't rely on old results
+            self.done.clear()
+        depends_on = None
+        for step in plan:
+            if step.attack_program is None:
+                continue
+            if (step.node not in self.done and step.node not in self.in_flight and
+                    step.node not in self.queue):
+                self.queue[step.node] = AttackTask(step.node, step.attack_program, depends_on)
+            depends_on = step.node
+
+    def Stop(self):
+        self.queue.clear()
+
+    def IsReady(self, task):
+        if task.depends_on is not None and task.depends_on not in self.done:
+            return False
+        return all(task.attack_program != in_flight.attack_program
+                   for in_flight, _ in self.in_flight.values())
+
+    def Pump(self):
+        now = self.clock()
+        for node, (task, sent_at) in list(self.in_flight.items()):
+            if now - sent_at > self.timeout:
+                del self.in_flight[node]
+                self.pending_attacks.Discard(task.attack_program, node)
+                self.Fail(task, 'no reply')
+        while self.queue and len(self.in_flight) < self.max_in_flight:
+            if self.next_send is not None and now < self.next_send:
+                return
+            task = next((t for t in self.queue.values() if self.IsReady(t)), None)
+            if task is None:
+                return
+            del self.queue[task.node]
+            self.in_flight[task.node] = (task, now)
+            self.next_send = NextSendTime(self.next_send, now, self.min_interval)
+            self.send('#%d %s' % (task.attack_program, task.node))
+
+    def OnAttackResult(self, node, success):
+        in_flight = self.in_flight.pop(node, None)
+        if in_flight is None:
+            return
+        if success:
+            self.done.add(node)
+        else:
+            self.Fail(in_flight[0], 'attack failed')
+        self.Pump()
+
+    def Fail(self, task, reason):
+        failed = [task.node]
+        # Plans are queued in order, so dependent attacks follow the failed one
+        for node, queued in list(self.queue.items()):
+            if queued.depends_on in failed:
+                failed.append(node)
+                del self.queue[node]
+        prof.cons_show('Autoattack on %s failed (%s), dropped: %s' %
+                       (task.node, reason, ', '.join(failed[1:]) or 'nothing'))
+
+
+# Maps a system breadth-first from its firewall: looks at every node found
+# and asks for info about programs not known yet. Runs an asyncio loop in a
+# thread of its own. Replies arrive through the message hooks and are
+# matched to queries by content, so they may come in any order. prof is
+# only used on the client thread, by Pump.
+class Crawler:
+    def __init__(self, send, system, window=None, min_interval=None, timeout=None,
+                 clock=time.monotonic):
+        self.send = send
+        self.system = system
+        self.window = window or CRAWL_WINDOW
+        self.min_interval = CRAWL_MIN_INTERVAL if min_interval is None else min_interval
+        self.timeout = timeout or CRAWL_TIMEOUT
+        self.clock = clock
+        # Commands to send and lines to show, queued by the loop
+        self.outbox = deque()
+        self.messages = deque()
+        self.next_send = None
+        self.loop = None
+        self.task = None
+        self.thread = None
+        # ('look', node) or ('info', program) -> future of the reply
+        self.waiting = dict()
+        self.seen_nodes = set()
+        self.asked_programs = set()
+        self.unavailable = []
+        self.timeouts = []
+        self.programs_found = 0
+        self.stopped = False
+        self.done = threading.Event()
+
+    def Start(self):
+        self.thread = threading.Thread(target=asyncio.run, args=(self.Run(),), daemon=True)
+        self.thread.start()
+
+    def Stop(self):
+        self.stopped = True
+        self.CallInLoop(lambda: self.task.cancel())
+        if self.thread is not None:
+            self.thread.join()
+        self.ShowMessages()
+
+    # Sends queued commands due, one per min_interval, and shows queued
+    # lines. Called on the client thread.
+    def Pump(self):
+        now = self.clock()
+        while self.outbox:
+            if self.next_send is not None and now < self.next_send:
+                break
+            self.next_send = NextSendTime(self.next_send, now, self.min_interval)
+            self.send(self.outbox.popleft())
+        self.ShowMessages()
+
+    def ShowMessages(self):
+        while self.messages:
+            prof.cons_show(self.messages.popleft())
+
+    def CallInLoop(self, callback, *args):
+        loop = self.loop
+        if loop is None or self.done.is_set():
+            return
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # Finished meanwhile and closed its loop
+            pass
+
+    # Called by the message hooks with what they parsed out of a message
+    def OnMessage(self, message, parsed, facts):
+        replies = []
+        if isinstance(parsed, NodeInfo):
+            m = NODE_SYSTEM_RE.search(message)
+            if m and m.group(1) == self.system:
+                replies.append((('look', parsed.node), parsed))
+        if isinstance(parsed, ProgramInfoParsed):
+            replies.append((('info', parsed.program), parsed))
+        for fact in facts:
+            if isinstance(fact, NodeUnavailable) and fact.system == self.system:
+                replies.append((('look', fact.node), None))
+        for m in INCORRECT_PROGRAM_RE.finditer(message):
+            replies.append((('info', int(m.group(1))), None))
+        if replies:
+            self.CallInLoop(self.Resolve, replies)
+
+    def Resolve(self, replies):
+        for key, reply in replies:
+            future = self.waiting.pop(key, None)
+            if future is not None and not future.done():
+                future.set_result(reply)
+
+    async def Query(self, key, command):
+        async with self.semaphore:
+            future = self.loop.create_future()
+            self.waiting[key] = future
+            self.outbox.append(command)
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                self.waiting.pop(key, None)
+                self.timeouts.append(command)
+                return None
+
+    def Visit(self, node):
+        if node not in self.seen_nodes:
+            self.seen_nodes.add(node)
+            self.tasks.append(self.loop.create_task(self.Look(node)))
+
+    def Ask(self, program):
+        if not program or program in self.asked_programs:
+            return
+        with programs_lock:
+            if program in known_programs:
+                return
+        self.asked_programs.add(program)
+        self.tasks.append(self.loop.create_task(self.Info(program)))
+
+    async def Look(self, node):
+        node_info = await self.Query(('look', node), 'look %s' % node)
+        if node_info is None:
+            self.unavailable.append(node)
+            return
+        self.Ask(node_info.program)
+        for child in node_info.childs:
+            self.Visit(child.node)
+            self.Ask(child.program)
+
+    async def Info(self, program):
+        if await self.Query(('info', program), 'info %d' % program) is not None:
+            self.programs_found += 1
+
+    async def Run(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        # Waiters are woken in order, so queries are sent breadth-first
+        self.semaphore = asyncio.Semaphore(self.window)
+        self.tasks = []
+        try:
+            if self.stopped:
+                raise asyncio.CancelledError()
+            self.Visit('firewall')
+            # The graph is complete once no query is left to wait for
+            while self.tasks:
+                tasks, self.tasks = self.tasks, []
+                await asyncio.gather(*tasks)
+            self.messages.append(self.Summary())
+        except asyncio.CancelledError:
+            self.outbox.clear()
+            self.messages.append('Crawl of %s stopped' % self.system)
+        finally:
+            self.done.set()
+
+    def Summary(self):
+        return ('Crawled %s: %d nodes looked at, %d not available (%s), '
+                '%d of %d programs found, %d queries timed out' % (
+                    self.system, len(self.seen_nodes) - len(self.unavailable),
+                    len(self.unavailable), ', '.join(sorted(self.unavailable)) or 'none',
+                    self.programs_found, len(self.asked_programs), len(self.timeouts)))
+
+
+# Knowledge shared by the team. Updates are buffered and written in one
+# transaction by Flush. Every flush gets the next sequence number, so Pull
+# returns only rows changed since the last one it has seen. A node update
+# only replaces a fresher one.
+class TeamStore:
+    def __init__(self, file_name):
+        self.connection = sqlite3.connect(file_name, timeout=10, check_same_thread=False,
+                                          isolation_level=None)
+        self.lock = threading.Lock()
+        self.programs = dict()
+        self.nodes = dict()
+        self.edges = set()
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS sequence (seq INTEGER NOT NULL);
+                INSERT INTO sequence SELECT 0 WHERE NOT EXISTS (SELECT * FROM sequence);
+                CREATE TABLE IF NOT EXISTS programs (
+                    program INTEGER PRIMARY KEY, info TEXT, updated REAL, seq INTEGER);
+                CREATE TABLE IF NOT EXISTS nodes (
+                    system TEXT, node TEXT, fields TEXT, updated REAL, seq INTEGER,
+                    PRIMARY KEY (system, node));
+                CREATE TABLE IF NOT EXISTS edges (
+                    system TEXT, source TEXT, target TEXT, seq INTEGER,
+                    PRIMARY KEY (system, source, target));
+                CREATE INDEX IF NOT EXISTS programs_seq ON programs (seq);
+                CREATE INDEX IF NOT EXISTS nodes_seq ON nodes (seq);
+                CREATE INDEX IF NOT EXISTS edges_seq ON edges (seq);
+            ''')
+
+    def PushProgram(self, program_info, updated):
+        with self.lock:
+            self.programs[program_info.program] = (program_info, updated)
+
+    def PushNode(self, system, node, fields, updated):
+        with self.lock:
+            self.nodes[(system, node)] = (fields, updated)
+
+    def PushEdge(self, system, source, target):
+        with self.lock:
+            self.edges.add((system, source, target))
+
+    def Flush(self):
+        with self.lock:
+            if not self.programs and not self.nodes and not self.edges:
+                return
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                seq = cursor.execute('SELECT seq FROM sequence').fetchone()[0] + 1
+                cursor.execute('UPDATE sequence SET seq = ?', (seq,))
+                cursor.executemany(
+                    'INSERT INTO programs VALUES (?, ?, ?, ?) ON CONFLICT (program) DO UPDATE '
+                    'SET info = excluded.info, updated = excluded.updated, seq = excluded.seq '
+                    'WHERE excluded.updated > programs.updated AND excluded.info != programs.info',
+                    [(program, json.dumps(program_info), updated, seq)
+                     for program, (program_info, updated) in self.programs.items()])
+                cursor.executemany(
+                    'INSERT INTO nodes VALUES (?, ?, ?, ?, ?) ON CONFLICT (system, node) DO UPDATE '
+                    'SET fields = excluded.fields, updated = excluded.updated, seq = excluded.seq '
+                    'WHERE excluded.updated > nodes.updated AND excluded.fields != nodes.fields',
+                    [(system, node, json.dumps(fields), updated, seq)
+                     for (system, node), (fields, updated) in self.nodes.items()])
+                cursor.executemany('INSERT OR IGNORE INTO edges VALUES (?, ?, ?, ?)',
+                                   [edge + (seq,) for edge in self.edges])
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            self.programs.clear()
+            self.nodes.clear()
+            self.edges.clear()
+
+    # Returns the last sequence number and programs, nodes and edges changed
+    # after since
+    def Pull(self, since):
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN')
+            try:
+                seq = cursor.execute('SELECT seq FROM sequence').fetchone()[0]
+                programs = [ProgramInfoParsed(*json.loads(info)) for info, in cursor.execute(
+                    'SELECT info FROM programs WHERE seq > ? ORDER BY seq', (since,))]
+                nodes = [(system, node, tuple(json.loads(fields)), updated)
+                         for system, node, fields, updated in
+                         cursor.execute('SELECT system, node, fields, updated FROM nodes '
+                                        'WHERE seq > ? ORDER BY seq', (since,))]
+                edges = cursor.execute('SELECT system, source, target FROM edges '
+                                       'WHERE seq > ? ORDER BY seq', (since,)).fetchall()
+            finally:
+                cursor.execute('COMMIT')
+            return seq, programs, nodes, edges
+
+    def Close(self):
+        self.Flush()
+        with self.lock:
+            self.connection.close()
+
+
+# Plugin state of one account talking to one bot, message hooks of
+# different sessions may run in parallel. System graphs and known programs
+# are shared by all sessions, only changing graphs takes processors_lock.
+class Session:
+    def __init__(self, account, bot_jid):
+        self.account = account
+        self.bot_jid = bot_jid
+        self.last_command = ''
+        self.proxy_level = None
+        self.current_system = None
+        self.pending_attacks = PendingAttacks()
+        self.autoattacker = AutoAttacker(self.Send, pending_attacks=self.pending_attacks)
+        self.crawler = None
+        # Systems changed by the last messages, rendered by the display hook
+        self.updated_systems = set()
+        # Guards session state shared between message hooks and commands.
+        # Taken before processors_lock when both are needed.
+        self.lock = threading.RLock()
+
+    def Send(self, command):
+        prof.send_line('/msg %s %s' % (self.bot_jid, command))
+
+    def GetCurrentProcessor(self):
+        return GetProcessor(self.current_system)
+
+    # System a message is about, when the message says so
+    def MessageSystem(self, message, pattern):
+        m = pattern.search(message)
+        return m.group(1) if m else self.current_system
+
+    def IngestPassively(self, message):
+        facts = list(ExtractFacts(message))
+        for fact in facts:
+            if isinstance(fact, SystemTraced):
+                if self.proxy_level is not None:
+                    self.proxy_level = max(self.proxy_level - fact.proxy_decrease, 0)
+                continue
+            with processors_lock:
+                processor = GetProcessor(fact.system)
+                if isinstance(fact, NodeAttacked):
+                    processor.OnNodeAttacked(fact)
+                elif isinstance(fact, NodeUnavailable):
+                    processor.OnNodeUnavailable(fact)
+                elif isinstance(fact, SystemFound):
+                    processor.OnSystemFound(fact)
+            self.updated_systems.add(fact.system)
+        return facts
+
+    def OnMessage(self, message):
+        if message == 'ok':
+            m = TARGET_COMMAND_RE.search(self.last_command)
+            if m:
+                self.current_system = m.group(1)
+
+        parsed = ParseIncomingMessage(message)
+        if isinstance(parsed, StatusParsed):
+            self.current_system = parsed.target
+            self.proxy_level = parsed.proxy_level
+
+        facts = self.IngestPassively(message)
+        if self.crawler is not None:
+            self.crawler.OnMessage(message, parsed, facts)
+
+        if isinstance(parsed, NodeInfo):
+            system = self.MessageSystem(message, NODE_SYSTEM_RE)
+            with processors_lock:
+                processor = GetProcessor(system)
+                processor.OnNodeInfo(parsed)
+                last_know_program = processor.graph.nodes[parsed.node].program
+            self.updated_systems.add(system)
+            if not parsed.program and last_know_program:
+                message = message + '\nLast known defense program: %d' % last_know_program
+            message = (message + '\nFollowing attacks are available:\n' +
+                MakeHackTooltip(last_know_program, parsed.node_type))
+
+        if isinstance(parsed, AttackParsed):
+            target = self.pending_attacks.Pop(parsed.attack_program)
+            if target is None:
+                m = ATTACK_COMMAND_RE.search(self.last_command)
+                target = m.group(2) if m else None
+            # The reply naming the node beats guessing it from sent commands
+            for fact in facts:
+                if isinstance(fact, NodeAttacked):
+                    target = fact.node
+            attack_index.AddObservedDefense(parsed.attack_program, parsed.defense_program)
+            node_type = None
+            if target:
+                system = self.MessageSystem(message, ATTACK_TARGET_RE)
+                with processors_lock:
+                    processor = GetProcessor(system)
+                    processor.OnAttackParsed(parsed, target)
+                    node_type = processor.graph.nodes[target].node_type
+                self.updated_systems.add(system)
+                self.autoattacker.OnAttackResult(target, parsed.success)
+            if parsed.attack_program is not None and parsed.success is not None:
+                attack_outcomes.Record(AttackOutcome(
+                    parsed.attack_program, parsed.defense_program, node_type, parsed.success))
+
+        if isinstance(parsed, ProgramInfoParsed):
+            LearnProgram(parsed)
+
+        if isinstance(parsed, DontCareParsed):
+            m = ATTACK_START_RE.search(message)
+            if m and ('Error 406: node disabled' in message or 'not available' in message):
+                target = self.pending_attacks.Pop(int(m.group(1)))
+                if target:
+                    # Already disabled is as good as a successful attack
+                    self.autoattacker.OnAttackResult(target, 'Error 406' in message)
+            return message
+
+        if not parsed:
+            prof.log_warning('Not able to parse message:')
+            prof.log_warning(message)
+            prof.log_warning('(EOM)')
+        return message
+
+    def OnSend(self, message):
+        self.last_command = message
+        m = ATTACK_COMMAND_RE.search(message)
+        if m:
+            self.pending_attacks.Add(int(m.group(1)), m.group(2))
+
+
+# System graphs of all sessions, so sessions attacking the same system
+# change the same graph and files
+processors = ProcessorCache()
+# Guards processors and the graphs in it
+processors_lock = threading.RLock()
+# Systems changed since the last push to the team store, systems pushed
+# whole since startup and edges the team store is known to have, guarded
+# by processors_lock
+unshared_systems = set()
+shared_systems = set()
+shared_edges = dict()
 known_programs = dict()
+attack_index = AttackIndex()
+attack_outcomes = AttackOutcomes()
+programs_journal_records = 0
+# Guards known_programs and the programs files, attack_index has a lock of its own
+programs_lock = threading.RLock()
+# Account the client connected with last. Message hooks are not told which
+# account a message arrived on, so with several accounts connected all
+# messages are filed under the last one.
+current_account = None
+# Sessions by (account, bot JID)
+sessions = dict()
+sessions_lock = threading.Lock()
+# Session commands apply to, the one the user wrote to last
+active_session = None
+team_store = None
+# Last sequence number of the team store seen
+team_seq = 0
 
-def GetCurrentProcessor():
-    global processors
-    global current_system
-    if not current_system:
+def GetSession(bot_jid):
+    key = (current_account, bot_jid)
+    session = sessions.get(key, None)
+    if session is not None:
+        return session
+    with sessions_lock:
+        session = sessions.get(key, None)
+        if session is None:
+            session = Session(current_account, bot_jid)
+            sessions[key] = session
+        return session
+
+def AllSessions():
+    with sessions_lock:
+        return list(sessions.values())
+
+def GetProcessor(system):
+    if not system:
         return None
-    if not current_system in processors.keys():
-        processors[current_system] = PerSystemProcessor()
-    return processors[current_system]
+    processor = processors.get(system, None)
+    if processor is None:
+        processor = PerSystemProcessor()
+        processors[system] = processor
+    return processor
 
+# Pushes nodes changed since the last push, or all nodes of systems not
+# pushed since startup, and edges the team store does not have. The store
+# keeps the freshest version of every node.
+def PushToTeam(store, now):
+    for system in unshared_systems:
+        processor = processors.get(system, None)
+        if processor is None:
+            continue
+        for name, fields, updated in processor.StampChanges(now, system not in shared_systems):
+            store.PushNode(system, name, fields, updated)
+        shared_systems.add(system)
+        system_shared_edges = shared_edges.setdefault(system, set())
+        for edge in processor.graph.Edges():
+            if edge not in system_shared_edges:
+                store.PushEdge(system, *edge)
+                system_shared_edges.add(edge)
+    unshared_systems.clear()
+
+# Returns the systems changed
+def OnTeamUpdates(nodes, edges):
+    updated_systems = set()
+    for system, name, fields, updated in nodes:
+        if GetProcessor(system).OnTeamNode(name, fields, updated):
+            updated_systems.add(system)
+    for system, source, target in edges:
+        GetProcessor(system).graph.AddEdge(source, target)
+        shared_edges.setdefault(system, set()).add((source, target))
+        updated_systems.add(system)
+    return updated_systems
+
+# (defense program, node type) -> ((attack index, its version), verified
+# attacks, tooltip). Verified attacks are replaced rather than changed, so
+# the tooltip is valid while the index is unchanged and they are the very
+# same object.
+hack_tooltips = dict()
+
+# Attacks seen winning against the defense program on this node type come
+# first, attacks seen failing are left out whatever TheRule says.
+@Instrumented('tooltip')
 def MakeHackTooltip(defense_program, defense_type):
-    global known_programs
+    key = (defense_program, defense_type)
+    index = attack_index
+    # Read before the lookup, so a change meanwhile only causes a miss
+    version = (index, index.version)
+    verified = attack_outcomes.Verified(defense_program)
+    cached = hack_tooltips.get(key, None)
+    if cached is not None and cached[0] == version and cached[1] is verified:
+        return cached[2]
+    attacks = index.WinningAttacks(defense_program, defense_type)
     winning_attacks = []
-    for k, p in known_programs.items():
-        if (TheRule(k, defense_program) and 
-            (defense_type in p.node_types)):
-            winning_attacks.append('%d:%s' % (k, p.effect))
-    return '(' + ', '.join(winning_attacks) + ')'
+    for attack_program, node_type in attack_outcomes.VerifiedWinning(defense_program):
+        program_info = index.programs.get(attack_program, None)
+        if defense_type is not None:
+            if node_type is not None and node_type != defense_type:
+                continue
+            if node_type is None and program_info and defense_type not in program_info.node_types:
+                continue
+        winning_attacks.append('%d:%s verified' % (
+            attack_program, program_info.effect if program_info else '?'))
+    for p in attacks:
+        if p.program not in verified:
+            winning_attacks.append('%d:%s' % (p.program, p.effect))
+    tooltip = '(' + ', '.join(winning_attacks) + ')'
+    hack_tooltips[key] = (version, verified, tooltip)
+    return tooltip
+
+# Cheapest way from an entry node (see SystemGraph.Roots) to target, counted
+# in attacks: passing a disabled node is free, a node is broken with one of
+# the known programs winning against it, others can't be passed at all.
+# Returns the steps from the entry node down to target or None.
+def PlanAttack(processor, target, now=None):
+    graph = processor.graph
+    if target not in graph:
+        return None
+    now = time.time() if now is None else now
+    costs = dict()
+    def AttackCost(name):
+        if name not in costs:
+            node = graph.nodes[name]
+            if node.IsDisabled(now):
+                costs[name] = (0, None)
+            else:
+                winning_attacks = attack_index.WinningAttacks(node.program, node.node_type)
+                costs[name] = (1, winning_attacks[0].program) if winning_attacks else (None, None)
+        return costs[name]
+
+    distance = dict()
+    parent = dict()
+    queue = deque()
+    def Relax(name, from_name, from_distance):
+        cost = AttackCost(name)[0]
+        if cost is None or distance.get(name, float('inf')) <= from_distance + cost:
+            return
+        distance[name] = from_distance + cost
+        parent[name] = from_name
+        if cost == 0:
+            queue.appendleft(name)
+        else:
+            queue.append(name)
+
+    for name in graph.Roots():
+        Relax(name, None, 0)
+    # 0-1 BFS, a node may be queued again after its distance improved
+    done = set()
+    while queue:
+        name = queue.popleft()
+        if name in done:
+            continue
+        done.add(name)
+        if name == target:
+            break
+        for child in graph.Childs(name):
+            Relax(child, name, distance[name])
+    if target not in done:
+        return None
+    plan = []
+    name = target
+    while name is not None:
+        plan.append(PlanStep(name, AttackCost(name)[1]))
+        name = parent[name]
+    plan.reverse()
+    return plan
+
+def FormatPlan(target, plan):
+    if plan is None:
+        return 'No known way to reach %s' % target
+    attacks = [step for step in plan if step.attack_program is not None]
+    steps = ['%s (%s)' % (step.node, '#%d' % step.attack_program
+                          if step.attack_program is not None else 'disabled')
+             for step in plan]
+    return '%d attacks to reach %s: %s' % (len(attacks), target, ' -> '.join(steps))
+
+def CmdPlan(target):
+    session = active_session
+    if not session:
+        prof.cons_show('Target is not set')
+        return
+    with session.lock, processors_lock:
+        processor = session.GetCurrentProcessor()
+        if not processor:
+            prof.cons_show('Target is not set')
+            return
+        prof.cons_show(FormatPlan(target, PlanAttack(processor, target)))
+
+def FormatReachable(processor, now):
+    nodes = []
+    for name in processor.ReachableNodes(now):
+        node = processor.graph.nodes[name]
+        if node.IsDisabled(now) and node.disabled_until is not None:
+            nodes.append('%s (disabled for %d sec)' % (name, node.disabled_until - now))
+        elif node.IsDisabled(now):
+            nodes.append('%s (disabled)' % name)
+        else:
+            nodes.append(name)
+    return 'Reachable nodes: ' + (', '.join(nodes) if nodes else 'none')
+
+def CmdReachable():
+    session = active_session
+    if not session:
+        prof.cons_show('Target is not set')
+        return
+    with session.lock, processors_lock:
+        processor = session.GetCurrentProcessor()
+        if not processor:
+            prof.cons_show('Target is not set')
+            return
+        prof.cons_show(FormatReachable(processor, time.time()))
+
+def FormatDefenseQuery(defense_program):
+    attacks = ['%d:%s (%s)' % (p.program, p.effect, ', '.join(p.node_types))
+               for p in attack_index.AttacksAgainst(defense_program)]
+    return 'Attacks against #%d: %s' % (defense_program, ', '.join(attacks) or 'none known')
+
+def FormatAttackQuery(attack_program):
+    defenses = ['#%d' % d for d in attack_index.ObservedDefenses(attack_program)]
+    return 'Defenses seen for #%d: %s' % (attack_program, ', '.join(defenses) or 'none')
+
+def CmdQuery(kind, program):
+    program = program.lstrip('#')
+    if kind not in ['defense', 'attack'] or not program.isdigit():
+        prof.cons_show('Usage: /query defense|attack <program>')
+        return
+    if kind == 'defense':
+        prof.cons_show(FormatDefenseQuery(int(program)))
+    else:
+        prof.cons_show(FormatAttackQuery(int(program)))
+
+def FormatOutcomes(outcomes):
+    with outcomes.lock:
+        pairs = sorted(outcomes.disagreeing_pairs.items())
+        lines = ['%d attack outcomes seen, %d verified pairs' % (
+                     outcomes.records, sum(len(v) for v in outcomes.verified.values())),
+                 'TheRule disagrees with %d of them (%.0f%%), %d pairs still disagree' % (
+                     outcomes.disagreements,
+                     100.0 * outcomes.disagreements / max(outcomes.records, 1), len(pairs))]
+    for (attack_program, defense_program), success in pairs[:OUTCOMES_REPORT_PAIRS]:
+        lines.append('#%d against #%d: %s' % (
+            attack_program, defense_program, 'succeeded' if success else 'failed'))
+    return lines
+
+def CmdOutcomes():
+    for line in FormatOutcomes(attack_outcomes):
+        prof.cons_show(line)
+
+def OutcomesTick():
+    attack_outcomes.Flush()
+
+def CmdStats(action=None, count=None):
+    if action == 'on':
+        stats.enabled = True
+    elif action == 'off':
+        stats.enabled = False
+    elif action == 'reset':
+        stats.Reset()
+    elif action == 'profile' and (count is None or count.isdigit()):
+        stats.StartProfile(int(count or 20))
+        prof.cons_show('Profiling next %d messages' % stats.profile_messages)
+        return
+    elif action is not None:
+        prof.cons_show('Usage: /stats [on|off|reset|profile <messages>]')
+        return
+    prof.cons_show('Instrumentation is %s' % ('on' if stats.enabled else 'off'))
+    for line in stats.Format():
+        prof.cons_show(line)
+
+def StatsTick():
+    if stats.enabled:
+        for line in stats.Format():
+            prof.log_info('stats: ' + line)
+
+def CmdAutoattack(target):
+    session = active_session
+    if not session:
+        prof.cons_show('Target is not set')
+        return
+    with session.lock, processors_lock:
+        if target == 'stop':
+            session.autoattacker.Stop()
+            prof.cons_show('Autoattack stopped')
+            return
+        processor = session.GetCurrentProcessor()
+        if not processor:
+            prof.cons_show('Target is not set')
+            return
+        plan = PlanAttack(processor, target)
+        prof.cons_show(FormatPlan(target, plan))
+        if plan is not None:
+            session.autoattacker.Add(plan)
+            session.autoattacker.Pump()
+
+def CmdCrawl(action=None):
+    session = active_session
+    if action not in (None, 'stop'):
+        prof.cons_show('Usage: /crawl [stop]')
+        return
+    if action == 'stop':
+        if session:
+            StopCrawler(session)
+        return
+    if not session:
+        prof.cons_show('Target is not set')
+        return
+    with session.lock:
+        crawler = session.crawler
+        if crawler is not None and not crawler.done.is_set():
+            prof.cons_show('Already crawling %s' % crawler.system)
+            return
+        if not session.current_system:
+            prof.cons_show('Target is not set')
+            return
+        session.crawler = Crawler(session.Send, session.current_system)
+        session.crawler.Start()
+        prof.cons_show('Crawling %s' % session.current_system)
+
+def StopCrawler(session):
+    with session.lock:
+        crawler, session.crawler = session.crawler, None
+    if crawler is not None:
+        crawler.Stop()
+
+def StopCrawlers():
+    for session in AllSessions():
+        StopCrawler(session)
+
+def CrawlTick():
+    for session in AllSessions():
+        with session.lock:
+            crawler = session.crawler
+            if crawler is None:
+                continue
+            done = crawler.done.is_set()
+            crawler.Pump()
+            if done:
+                session.crawler = None
+
+def AutoattackTick():
+    for session in AllSessions():
+        with session.lock:
+            if not session.autoattacker.IsIdle():
+                session.autoattacker.Pump()
+
+def ProgramsSnapshotFileName():
+    return OUTPUT_LOCATION + 'programs.json'
+
+def ProgramsJournalFileName():
+    return OUTPUT_LOCATION + 'programs.jsonl'
+
+# programs.json holds a snapshot of known_programs, every program learned
+# since then is appended to programs.jsonl as a single line.
+def LoadKnownPrograms():
+    global known_programs
+    global attack_index
+    global programs_journal_records
+    with programs_lock:
+        known_programs = dict()
+        programs_journal_records = 0
+        if os.path.isfile(ProgramsSnapshotFileName()):
+            with open(ProgramsSnapshotFileName()) as f:
+                tmp = json.load(f)
+                for k, v in tmp.items():
+                    known_programs[int(k)] = ProgramInfoParsed(*v)
+        if os.path.isfile(ProgramsJournalFileName()):
+            complete_size = 0
+            with open(ProgramsJournalFileName(), 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Torn write of the last record
+                        prof.log_warning('Dropping torn programs journal record: %s' % line)
+                        break
+                    complete_size += len(line)
+                    try:
+                        program_info = ProgramInfoParsed(*json.loads(line))
+                    except (ValueError, TypeError):
+                        prof.log_warning('Skipping broken programs journal record: %s' % line)
+                        continue
+                    known_programs[program_info.program] = program_info
+                    programs_journal_records += 1
+            # Otherwise the next record would be appended to the torn one
+            if complete_size != os.path.getsize(ProgramsJournalFileName()):
+                os.truncate(ProgramsJournalFileName(), complete_size)
+        attack_index = AttackIndex(known_programs.values())
+
+@Instrumented('save_program')
+def SaveKnownProgram(program_info):
+    global programs_journal_records
+    with open(ProgramsJournalFileName(), 'a') as f:
+        f.write(json.dumps(program_info) + '\n')
+    programs_journal_records += 1
+    if programs_journal_records >= PROGRAMS_JOURNAL_MAX_RECORDS:
+        CompactKnownPrograms()
+
+@Instrumented('compact_programs')
+def CompactKnownPrograms():
+    global programs_journal_records
+    tmp_file_name = ProgramsSnapshotFileName() + '.tmp'
+    with open(tmp_file_name, 'w') as f:
+        json.dump(known_programs, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file_name, ProgramsSnapshotFileName())
+    # Replaying records which are already in the snapshot is harmless, so
+    # crashing before truncation loses nothing.
+    open(ProgramsJournalFileName(), 'w').close()
+    programs_journal_records = 0
+
+def OutcomesFileName():
+    return OUTPUT_LOCATION + 'outcomes.jsonl'
+
+def LearnProgram(program_info, share=True):
+    with programs_lock:
+        if known_programs.get(program_info.program, None) == program_info:
+            return
+        known_programs[program_info.program] = program_info
+        attack_index.Add(program_info)
+        SaveKnownProgram(program_info)
+        if share and team_store:
+            team_store.PushProgram(program_info, time.time())
+
+def TeamSyncTick():
+    global team_seq
+    if not team_store:
+        return
+    with processors_lock:
+        PushToTeam(team_store, time.time())
+    team_store.Flush()
+    seq, programs, nodes, edges = team_store.Pull(team_seq)
+    team_seq = seq
+    for program_info in programs:
+        LearnProgram(program_info, share=False)
+    if not nodes and not edges:
+        return
+    with processors_lock:
+        for system in OnTeamUpdates(nodes, edges):
+            render_scheduler.MarkDirty(system)
+
+# Only loaded systems have timers running, evicted ones catch up when
+# loaded again
+def ExpiryTick():
+    now = time.time()
+    with processors_lock:
+        for system, processor in processors.loaded.items():
+            if processor.ExpireDisabled(now):
+                render_scheduler.MarkDirty(system)
+                unshared_systems.add(system)
 
 def prof_init(version, status, account_name, fulljid):
+    global current_account
+    global active_session
+    global team_store
+    global team_seq
+    global attack_outcomes
     global processors
-    global known_programs
-    saved_graphs = glob.glob(OUTPUT_LOCATION + 'dot/*.dot')
-    processors = dict()
-    for g in saved_graphs:
-        system_name = os.path.basename(os.path.splitext(g)[0])
-        processors[system_name] = PerSystemProcessor(nx.DiGraph(nx_pydot.read_dot(g)))
-    known_programs = dict()
-    if os.path.isfile(OUTPUT_LOCATION + 'programs.json'):
-        with open(OUTPUT_LOCATION + 'programs.json') as f:
-            tmp = json.load(f)
-            for k, v in tmp.items():
-                known_programs[int(k)] = ProgramInfoParsed(v[0], v[1], v[2], v[3], v[4])
+    current_account = account_name
+    with sessions_lock:
+        sessions.clear()
+    active_session = None
+    with processors_lock:
+        processors = ProcessorCache(SavedSystems())
+        unshared_systems.clear()
+        shared_systems.clear()
+        shared_edges.clear()
+    LoadKnownPrograms()
+    attack_outcomes.Close()
+    attack_outcomes = AttackOutcomes(OutcomesFileName())
+    # Defenses attacks were executed against survive restarts this way
+    for defense_program, attacks in attack_outcomes.verified.items():
+        for attack_program in attacks:
+            attack_index.AddObservedDefense(attack_program, defense_program)
+    team_store = TeamStore(TEAM_STORE_LOCATION) if TEAM_STORE_LOCATION else None
+    team_seq = 0
+    if team_store:
+        # Teammates may not have seen what was learned while offline
+        with processors_lock:
+            unshared_systems.update(processors.keys())
+    prof.register_command('/plan', 1, 1,
+                          ['/plan <node>'],
+                          'Shows the cheapest known way to reach a node of the current target.',
+                          [['<node>', 'Node to reach']],
+                          ['/plan VPN4'],
+                          CmdPlan)
+    prof.register_command('/autoattack', 1, 1,
+                          ['/autoattack <node>', '/autoattack stop'],
+                          'Attacks nodes of the current target along the /plan path.',
+                          [['<node>', 'Node to reach'], ['stop', 'Drop attacks not sent yet']],
+                          ['/autoattack VPN4'],
+                          CmdAutoattack)
+    prof.register_timed(AutoattackTick, PUMP_INTERVAL)
+    prof.register_timed(CrawlTick, PUMP_INTERVAL)
+    prof.register_command('/crawl', 0, 1,
+                          ['/crawl', '/crawl stop'],
+                          'Looks at every node of the current target and asks for info about '
+                          'unknown programs.',
+                          [['stop', 'Stop crawling']],
+                          ['/crawl'],
+                          CmdCrawl)
+    prof.register_command('/reachable', 0, 0,
+                          ['/reachable'],
+                          'Lists nodes of the current target which can be looked at right now.',
+                          [],
+                          ['/reachable'],
+                          CmdReachable)
+    prof.register_timed(ExpiryTick, 1)
+    prof.register_command('/query', 2, 2,
+                          ['/query defense <program>', '/query attack <program>'],
+                          'Lists known attacks dividing a defense program (e.g. of a cryptocore) '
+                          'or defense programs an attack program was executed against.',
+                          [['defense <program>', 'Defense program to break'],
+                           ['attack <program>', 'Attack program to look up']],
+                          ['/query defense 2209900', '/query attack 700'],
+                          CmdQuery)
+    prof.register_command('/outcomes', 0, 0,
+                          ['/outcomes'],
+                          'Shows how often TheRule disagrees with outcomes of attacks seen.',
+                          [],
+                          ['/outcomes'],
+                          CmdOutcomes)
+    prof.register_timed(OutcomesTick, OUTCOMES_FLUSH_INTERVAL)
+    prof.register_command('/stats', 0, 2,
+                          ['/stats', '/stats on|off|reset', '/stats profile <messages>'],
+                          'Shows timings of message handling, rendering and persistence.',
+                          [['on|off', 'Enable or disable instrumentation'],
+                           ['reset', 'Forget collected timings'],
+                           ['profile <messages>', 'Log a cProfile report of the next messages']],
+                          ['/stats on', '/stats profile 50'],
+                          CmdStats)
+    prof.register_timed(StatsTick, STATS_LOG_INTERVAL)
+    prof.register_timed(WarningsTick, 1)
+    prof.register_timed(TeamSyncTick, TEAM_SYNC_INTERVAL)
 
 
+@Instrumented('message')
 def prof_pre_chat_message_display_no_print(barejid, resource, message):
     if not IsCyberSpaceBot(barejid): return message
     prof.log_info('prof_pre_chat_message_display')
     prof.log_info("barejid: %s\nmessage: %s" % (barejid, message))
+    session = GetSession(barejid)
+    with session.lock:
+        return session.OnMessage(message)
 
-    global last_command
-    global proxy_level
-    global current_system
-    global processors
-    global known_programs
+def RenderSystem(name):
+    with processors_lock:
+        processor = processors.get(name, None)
+        if not processor:
+            return
+        snapshot = processor.Snapshot()
+    snapshot.PrintToPdf(name)
+    SaveRendered(name, processor, snapshot)
 
-    if message == 'ok':
-        m = re.search('target ([a-zA-Z0-9_]*)', last_command, re.MULTILINE)
-        current_system = m.group(1)
-
-    parsed = ParseIncomingMessage(message)
-    if isinstance(parsed, StatusParsed):
-        current_system = parsed.target
-        proxy_level = parsed.proxy_level
-
-    if isinstance(parsed, NodeInfo):
-        GetCurrentProcessor().OnNodeInfo(parsed)
-        last_know_program = GetCurrentProcessor().graph.node[parsed.node].get('program', None)
-        if not parsed.program and last_know_program:
-            message = message + '\nLast known defense program: %d' % last_know_program
-        message = (message + '\nFollowing attacks are available:\n' + 
-            MakeHackTooltip(last_know_program, parsed.node_type))
-
-    if isinstance(parsed, AttackParsed):
-        m = re.search('#\d+ ([a-zA-Z0-9_]+)', last_command, re.MULTILINE)
-        GetCurrentProcessor().OnAttackParsed(
-            parsed, m.group(1))
-
-    if isinstance(parsed, ProgramInfoParsed):
-        known_programs[parsed.program] = parsed
-        with open(OUTPUT_LOCATION + 'programs.json', 'w') as f:
-            json.dump(known_programs, f, indent=2)
-
-    if isinstance(parsed, DontCareParsed):
-        return message
+# Saves the system after a snapshot of processor was rendered. The snapshot
+# itself may be older than what an eviction saved meanwhile, so the newest
+# processor is saved, next to the .dot file the render wrote. Only taking
+# its data holds processors_lock, not writing it.
+def SaveRendered(name, processor, snapshot):
+    with processors_lock:
+        processor = processors.loaded.get(name, processor)
+        processor.positions.update(snapshot.positions)
+        data = processor.SnapshotData(name)
+    WriteSnapshot(name, data)
 
-    if not parsed:
-        prof.log_warning('Not able to parse message:')
-        prof.log_warning(message)
-        prof.log_warning('(EOM)')
-        return message
-    return message
+render_scheduler = RenderScheduler(RenderSystem)
 
 def prof_pre_chat_message_display(barejid, resource, message):
-    res = prof_pre_chat_message_display_no_print(barejid, resource, message)
-    if current_system:
-        GetCurrentProcessor().PrintToPdf(current_system)
+    if not IsCyberSpaceBot(barejid): return message
+    session = GetSession(barejid)
+    with session.lock:
+        res = stats.Profiled(prof_pre_chat_message_display_no_print, barejid, resource, message)
+        if session.current_system:
+            session.updated_systems.add(session.current_system)
+        for system in session.updated_systems:
+            render_scheduler.MarkDirty(system)
+        with processors_lock:
+            unshared_systems.update(session.updated_systems)
+        session.updated_systems.clear()
 
 def prof_pre_chat_message_send(barejid, message):
     if not IsCyberSpaceBot(barejid): return message
     prof.log_info('prof_pre_chat_message_send')
     prof.log_info("barejid: %s\nmessage: %s" % (barejid, message))
-    global last_command
-    last_command = message
+    global active_session
+    session = GetSession(barejid)
+    active_session = session
+    with session.lock:
+        session.OnSend(message)
     return message
 
+def prof_on_connect(account_name, fulljid):
+    global current_account
+    current_account = account_name
 
-def PrintAllPdfs():
-    global processors
-    for name, processor in processors.items():
-        processor.PrintToPdf(name)
+
+def prof_on_shutdown():
+    StopCrawlers()
+    render_scheduler.Stop()
+    with processors_lock:
+        # Only pushed, pulling now would change graphs nothing saves or renders
+        if team_store:
+            PushToTeam(team_store, time.time())
+        # After pushing, which stamps the changes
+        processors.SaveLoaded()
+    with programs_lock:
+        if programs_journal_records:
+            CompactKnownPrograms()
+    attack_outcomes.Close()
+    if team_store:
+        team_store.Close()
+
+def prof_on_unload():
+    StopCrawlers()
+    render_scheduler.Stop()
+
+
+def RenderedHash(name):
+    if not os.path.isfile(RenderFileName(name)):
+        return None
+    try:
+        with open(RenderedHashFileName(name)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def RenderSnapshot(name, snapshot):
+    start = time.perf_counter()
+    try:
+        result = snapshot.PrintToPdf(name)
+        if result != 0:
+            return RenderResult(name, 'failed', time.perf_counter() - start,
+                                'dot exited with code %s' % result)
+    except Exception as e:
+        return RenderResult(name, 'failed', time.perf_counter() - start, str(e))
+    return RenderResult(name, 'rendered', time.perf_counter() - start, None)
+
+# Renders one system of PrintAllPdfs. Only hashing and copying its graph
+# holds processors_lock, and a system rendered before is not copied.
+def RenderSavedSystem(name):
+    rendered_hash = RenderedHash(name)
+    with processors_lock:
+        processor = processors[name]
+        if processor.ContentHash() == rendered_hash:
+            return RenderResult(name, 'unchanged', 0.0, None)
+        snapshot = processor.Snapshot()
+    result = RenderSnapshot(name, snapshot)
+    if result.status == 'rendered':
+        SaveRendered(name, processor, snapshot)
+    return result
+
+# Renders every system whose graph changed since its last PDF, running up
+# to one graphviz process per core. Failures are reported, not raised.
+def PrintAllPdfs(max_workers=None):
+    with processors_lock:
+        names = processors.keys()
+    with ThreadPoolExecutor(max_workers or os.cpu_count()) as executor:
+        results = list(executor.map(RenderSavedSystem, names))
+    for result in sorted(results):
+        if result.status == 'failed':
+            prof.log_warning('Failed to render %s: %s' % (result.system, result.error))
+        else:
+            prof.log_info('%s: %s in %.3f sec' % (result.system, result.status, result.seconds))
+    return sorted(results)
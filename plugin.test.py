@@ -1,11 +1,130 @@
 import unittest
 import unittest.mock as mock
 import sys
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
 sys.modules['prof'] = mock.MagicMock()
 import plugin
+import history_processor
+from collections import deque
+
+
+# Answers attack commands the way darknet@cyberspace does, replies are held
+# back until Reply is called.
+class FakeBot:
+    def __init__(self, system, nodes):
+        self.system = system
+        self.nodes = nodes
+        self.disabled = set()
+        self.commands = []
+        self.replies = deque()
+
+    def Send(self, command):
+        self.commands.append(command)
+        plugin.prof_pre_chat_message_send('darknet@cyberspace', command)
+        m = re.match(r'#(\d+) (\w+)', command)
+        attack_program, node = int(m.group(1)), m.group(2)
+        defense_program = self.nodes[node]
+        reply = 'executing program #%d from willy220 target:%s \n' % (attack_program, self.system)
+        if node in self.disabled:
+            reply += 'Error 406: node disabled\n'
+        elif plugin.TheRule(attack_program, defense_program):
+            self.disabled.add(node)
+            reply += ('Node defence: #%d\nattack successfull\n'
+                      "Node '%s' disabled for 600 seconds.\n" % (defense_program, node))
+        else:
+            reply += ('Node defence: #%d\nattack failed\nTrace:\nProxy level decreased by 1.\n'
+                      '%s security log updated\n' % (defense_program, self.system))
+        self.replies.append(reply)
+
+    def Reply(self):
+        plugin.prof_pre_chat_message_display_no_print(
+            'darknet@cyberspace', '', self.replies.popleft())
+
+
+# Answers look and info commands with the replies recorded in a history
+# file, the most detailed one when a command was sent several times.
+# Replies are delivered in threads of their own after a random delay.
+class HistoryBot:
+    def __init__(self, file_name, system):
+        self.system = system
+        self.replies = dict()
+        self.commands = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.send_threads = set()
+        self.lock = threading.Lock()
+        self.random = random.Random(1)
+        current_system = None
+        command = None
+        for direction, message in history_processor.ReadHistory(file_name):
+            if direction == 'to':
+                command = message.strip()
+                continue
+            if command is None:
+                continue
+            m = plugin.TARGET_COMMAND_RE.match(command)
+            if m and message == 'ok':
+                current_system = m.group(1)
+            # Programs are the same in every system
+            if current_system != system and not command.startswith('info '):
+                command = None
+                continue
+            if len(message) > len(self.replies.get(command, '')):
+                self.replies[command] = message
+            command = None
+
+    def SendLine(self, line):
+        command = re.match(r'/msg \S+ (.*)', line).group(1)
+        plugin.prof_pre_chat_message_send('darknet@cyberspace', command)
+        reply = self.replies.get(command, None)
+        if reply is None and command.startswith('info '):
+            reply = '\n--------------------\nincorrect program %s\nEND ----------------' % command[5:]
+        elif reply is None:
+            reply = ('\n--------------------\n%s/%s not available \n\nEND ----------------' %
+                     (self.system, command[5:]))
+        with self.lock:
+            self.commands.append(command)
+            self.send_threads.add(threading.current_thread())
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            delay = self.random.random() * 0.005
+        threading.Timer(delay, self.Reply, [reply]).start()
+
+    def Reply(self, reply):
+        with self.lock:
+            self.in_flight -= 1
+        plugin.prof_pre_chat_message_display('darknet@cyberspace', '', reply)
 
 
 class MyTest(unittest.TestCase):
+    def setUp(self):
+        patches = [mock.patch.dict(plugin.sessions, clear=True),
+                   mock.patch.object(plugin, 'active_session', None),
+                   mock.patch.object(plugin, 'current_account', None),
+                   mock.patch.object(plugin, 'team_store', None),
+                   mock.patch.object(plugin, 'processors', plugin.ProcessorCache()),
+                   mock.patch.object(plugin, 'unshared_systems', set()),
+                   mock.patch.object(plugin, 'shared_systems', set()),
+                   mock.patch.object(plugin, 'shared_edges', dict()),
+                   mock.patch.object(plugin, 'attack_outcomes', plugin.AttackOutcomes())]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def MakeSession(self, system, processor=None, bot_jid='darknet@cyberspace'):
+        session = plugin.GetSession(bot_jid)
+        session.current_system = system
+        if processor is not None:
+            plugin.processors[system] = processor
+        plugin.active_session = session
+        return session
+
     def testParsesStatusNoTarget(self):
         msg = '''
 --------------------
@@ -55,6 +174,7 @@ END ----------------
         self.assertEqual(parsed.program, 2209900)
         self.assertEqual(parsed.node_type, 'Firewall')
         self.assertTrue(parsed.disabled)
+        self.assertEqual(parsed.disabled_for, 440)
         self.assertEqual(parsed.node_effect, 'NoOp')
         self.assertEqual(parsed.childs, [
                          plugin.MakeChildNodeInfo('antivirus1',
@@ -261,6 +381,45 @@ attack successfull
         self.assertEqual(parsed.defense_program, 8247239)
         self.assertTrue(parsed.success)
 
+    def testParsesAttackWithDefenceAfterResult(self):
+        msg = '''
+executing program #847 from willy220 target:LadyInRed351
+Node defence: #8247239
+attack successfull
+Node defence: #2616796
+Trace:
+'''
+        parsed = plugin.ParseIncomingMessage(msg)
+        self.assertIsInstance(parsed, plugin.AttackParsed)
+        self.assertEqual(parsed.defense_program, 8247239)
+        self.assertTrue(parsed.success)
+
+    def testDoesNotParseUnfinishedAttack(self):
+        msg = '''
+executing program #847 from willy220 target:LadyInRed351
+Node defence: #8247239
+attack successfull'''
+        self.assertIsNone(plugin.ParseAttack(msg))
+
+    def testParsesHugeAttackInLinearTime(self):
+        header = 'executing program #847 from willy220 target:LadyInRed351\n'
+        trace = 'Trace:\nProxy level decreased by 1.\nNode defence: #8247239\n' * 5000
+        corpus = [
+            header + trace,
+            header + trace + 'attack failed',
+            header + trace + 'attack failed\n',
+            header * 10000,
+            'Node defence: #1\n' * 10000 + header,
+        ]
+        start = time.perf_counter()
+        for msg in corpus:
+            plugin.ParseIncomingMessage(msg)
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertIsNone(plugin.ParseIncomingMessage(corpus[0]))
+        self.assertIsNone(plugin.ParseIncomingMessage(corpus[1]))
+        self.assertEqual(plugin.ParseIncomingMessage(corpus[2]),
+                         plugin.AttackParsed(847, 8247239, False))
+
     def testDontCareAboutOk(self):
         msg = 'ok'
         parsed = plugin.ParseIncomingMessage(msg)
@@ -276,10 +435,1081 @@ END ----------------
         parsed = plugin.ParseIncomingMessage(msg)
         self.assertIsInstance(parsed, plugin.DontCareParsed)
 
+    def testDontCareAboutNetworkScan(self):
+        msg = '''scaning cluster alpha
+
+network scan started: 
+...
+Systems found:
+--------------------
+Citizen121    (firewall: #14510925 )
+--------------------
+
+END ----------------'''
+        parsed = plugin.ParseIncomingMessage(msg)
+        self.assertIsInstance(parsed, plugin.DontCareParsed)
+
+    def testDoesNotParseUnknownMessage(self):
+        self.assertIsNone(plugin.ParseIncomingMessage('Game not started yet'))
+        self.assertIsNone(plugin.ParseIncomingMessage('Node "broken'))
+
+    def testExtractsFactsFromMessages(self):
+        msg = ("executing program #1575 from willy220 target:BlackMirror944 \n"
+               "Trace:\nProxy level decreased by 1. \nBlackMirror944 security log updated\n"
+               "Node defence: #7684425\nattack successfull\nNode 'VPN1' disabled for 600 seconds.")
+        self.assertEqual(list(plugin.ExtractFacts(msg)), [
+            plugin.NodeAttacked('BlackMirror944', 'VPN1', 7684425, 600),
+            plugin.SystemTraced('BlackMirror944', 1)])
+        msg = ("executing program #20825 from willy220 target:ManInBlack \n"
+               "Node defence: #151335275\nattack successfull\n"
+               "Data in ManInBlack/system_information:\n--------------------\n")
+        self.assertEqual(list(plugin.ExtractFacts(msg)), [
+            plugin.NodeAttacked('ManInBlack', 'system_information', 151335275, None)])
+        msg = '\n--------------------\nCitizen121/antivirus not available \n\nEND ----------------'
+        self.assertEqual(list(plugin.ExtractFacts(msg)),
+                         [plugin.NodeUnavailable('Citizen121', 'antivirus')])
+        msg = ('network scan started: \n...\nSystems found:\n--------------------\n'
+               'Citizen121    (firewall: #14510925 )\nManInBlack    (firewall: #2209900 )\n')
+        self.assertEqual(list(plugin.ExtractFacts(msg)), [
+            plugin.SystemFound('Citizen121', 14510925), plugin.SystemFound('ManInBlack', 2209900)])
+        self.assertEqual(list(plugin.ExtractFacts('Game not started yet')), [])
+
+    def testMapsSystemsPassively(self):
+        session = self.MakeSession('BlackMirror944', self.MakePlanningProcessor())
+        session.current_system = 'ManInBlack'
+        session.proxy_level = 3
+        processors = plugin.processors
+        for msg in ['Systems found:\n--------------------\nCitizen121    (firewall: #14510925 )\n',
+                    'BlackMirror944/antivirus1 not available \n',
+                    'executing program #1100 from willy220 target:BlackMirror944 \n'
+                    'Node defence: #7993700\nattack successfull\n'
+                    "Node 'VPN3' disabled for 600 seconds.\n",
+                    'executing program #180 from willy220 target:BlackMirror944 \n'
+                    'Node defence: #43086043\nattack failed\nTrace:\n'
+                    'Proxy level decreased by 1. \nBlackMirror944 security log updated\n']:
+            plugin.prof_pre_chat_message_display_no_print('darknet@cyberspace', '', msg)
+        self.assertEqual(session.updated_systems, set(['Citizen121', 'BlackMirror944']))
+        self.assertEqual(session.proxy_level, 2)
+        firewall = processors['Citizen121'].graph.nodes['firewall']
+        self.assertEqual((firewall.program, firewall.node_type), (14510925, 'Firewall'))
+        graph = processors['BlackMirror944'].graph
+        self.assertFalse(graph.nodes['firewall'].disabled)
+        self.assertTrue(graph.nodes['VPN3'].disabled)
+        self.assertNotIn('ManInBlack', processors)
+
+    def testPersistsLearnedProgramsInJournal(self):
+        program_info = plugin.ProgramInfoParsed(1100, 'disable', None, ['Firewall'], 600)
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'):
+            plugin.prof_init(None, None, None, None)
+            plugin.LearnProgram(program_info)
+            plugin.LearnProgram(program_info)
+            with open(plugin.ProgramsJournalFileName()) as f:
+                self.assertEqual(len(f.readlines()), 1)
+            plugin.prof_init(None, None, None, None)
+            self.assertEqual(plugin.known_programs, {1100: program_info})
+
+    def testCompactsProgramsJournal(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'PROGRAMS_JOURNAL_MAX_RECORDS', 3):
+            plugin.prof_init(None, None, None, None)
+            for program in range(1, 5):
+                plugin.LearnProgram(plugin.ProgramInfoParsed(
+                    program, 'disable', None, ['Firewall'], 600))
+            with open(plugin.ProgramsJournalFileName()) as f:
+                self.assertEqual(len(f.readlines()), 1)
+            with open(plugin.ProgramsSnapshotFileName()) as f:
+                self.assertEqual(len(json.load(f)), 3)
+            plugin.prof_init(None, None, None, None)
+            self.assertEqual(sorted(plugin.known_programs.keys()), [1, 2, 3, 4])
+
+    def testIgnoresTornProgramsJournalRecord(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'):
+            plugin.prof_init(None, None, None, None)
+            plugin.LearnProgram(plugin.ProgramInfoParsed(450, 'get_data', None, ['Data'], 600))
+            with open(plugin.ProgramsJournalFileName(), 'a') as f:
+                f.write('[1100, "disa')
+            plugin.prof_init(None, None, None, None)
+            self.assertEqual(list(plugin.known_programs.keys()), [450])
+            plugin.LearnProgram(plugin.ProgramInfoParsed(700, 'disable', None, ['Firewall'], 600))
+            plugin.prof_init(None, None, None, None)
+            self.assertEqual(sorted(plugin.known_programs.keys()), [450, 700])
+
+    def testDivisors(self):
+        self.assertEqual(plugin.Divisors(1), (1,))
+        self.assertEqual(plugin.Divisors(12), (1, 2, 3, 4, 6, 12))
+        self.assertEqual(plugin.Divisors(2209900), tuple(
+            d for d in range(1, 2209901) if 2209900 % d == 0))
+
+    def testAttackIndexMatchesTheRule(self):
+        rng = random.Random(42)
+        node_types = ['Firewall', 'Antivirus', 'VPN', 'Brandmauer']
+        programs = [plugin.ProgramInfoParsed(p, 'disable', None,
+                                             rng.sample(node_types, 2), 600)
+                    for p in rng.sample(range(2, 5000), 1000)]
+        index = plugin.AttackIndex(programs)
+        for defense_program in [2209900, 1208700, 6449300, 7993700, 2, 9973]:
+            for node_type in node_types:
+                expected = [p for p in sorted(programs)
+                            if plugin.TheRule(p.program, defense_program) and
+                            node_type in p.node_types]
+                self.assertEqual(index.WinningAttacks(defense_program, node_type),
+                                 tuple(expected))
+        self.assertEqual(index.WinningAttacks(None, 'Firewall'), ())
+        self.assertEqual(index.WinningAttacks(2209900, 'Data'), ())
+
+    def testAttackIndexReplacesProgram(self):
+        index = plugin.AttackIndex([
+            plugin.ProgramInfoParsed(1100, 'disable', None, ['Firewall'], 600)])
+        index.Add(plugin.ProgramInfoParsed(1100, 'disable', None, ['VPN'], 600))
+        self.assertEqual(index.WinningAttacks(2209900, 'Firewall'), ())
+        self.assertEqual(len(index.WinningAttacks(2209900, 'VPN')), 1)
+
+    def testMakesHackTooltip(self):
+        with mock.patch.object(plugin, 'attack_index', plugin.AttackIndex([
+                plugin.ProgramInfoParsed(1100, 'disable', None, ['Firewall'], 600),
+                plugin.ProgramInfoParsed(700, 'disable', None, ['Firewall'], 600),
+                plugin.ProgramInfoParsed(3, 'disable', None, ['Firewall'], 600)])):
+            self.assertEqual(plugin.MakeHackTooltip(2209900, 'Firewall'),
+                             '(700:disable, 1100:disable)')
+            self.assertEqual(plugin.MakeHackTooltip(None, 'Firewall'), '()')
+
+    def MakeFirewallProcessor(self):
+        processor = plugin.PerSystemProcessor()
+        processor.OnNodeInfo(plugin.NodeInfo('firewall', 2209900, 'Firewall', True, 'NoOp', [
+            plugin.MakeChildNodeInfo('antivirus1', 1811628, 'Antivirus', False),
+            plugin.MakeChildNodeInfo('antivirus2', None, 'Antivirus', True)]))
+        return processor
+
+    def assertSameGraph(self, processor, expected):
+        self.assertEqual(sorted(processor.graph.Edges()), sorted(expected.graph.Edges()))
+        self.assertEqual({name: node.Fields() for name, node in processor.graph.nodes.items()},
+                         {name: node.Fields() for name, node in expected.graph.nodes.items()})
+
+    def testStoresGraphCompactly(self):
+        graph = self.MakeFirewallProcessor().graph
+        graph.AddEdge('firewall', 'antivirus1')
+        graph.AddEdge('antivirus1', ''.join(['VPN', '1']))
+        self.assertEqual(list(graph.Edges()), [('firewall', 'antivirus1'),
+                                               ('firewall', 'antivirus2'),
+                                               ('antivirus1', 'VPN1')])
+        self.assertEqual(graph.Childs('VPN1'), ())
+        self.assertIs(graph.Childs('antivirus1')[0], sys.intern('VPN1'))
+        self.assertEqual(graph.nodes['VPN1'].Fields(), (None, False, False, None, None, None))
+        with self.assertRaises(AttributeError):
+            graph.nodes['VPN1'].label = 'VPN1'
+
+    def testLoadsFirstVersionSnapshot(self):
+        graph = plugin.GraphFromSnapshot({
+            'version': 1,
+            'nodes': [('firewall', {'program': 2209900, 'disabled': True, 'label': 'firewall'}),
+                      ('antivirus1', {'disabled': False, 'effect': 'trace'})],
+            'edges': [('firewall', 'antivirus1')],
+        })
+        self.assertEqual(list(graph.Edges()), [('firewall', 'antivirus1')])
+        self.assertEqual(graph.nodes['firewall'].Fields(), (2209900, True, False, None, None, None))
+        self.assertEqual(graph.nodes['antivirus1'].Fields(), (None, False, False, 'trace', None, None))
+
+    def testLoadsProcessorFromSnapshot(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'call'):
+            os.mkdir(output + '/dot')
+            processor = self.MakeFirewallProcessor()
+            processor.PrintToPdf('ManInBlack')
+            processor.SaveSnapshot('ManInBlack')
+            with mock.patch.object(plugin.nx_pydot, 'read_dot') as read_dot:
+                plugin.prof_init(None, None, None, None)
+                read_dot.assert_not_called()
+            processors = plugin.processors
+            self.assertEqual(list(processors.keys()), ['ManInBlack'])
+            self.assertSameGraph(processors['ManInBlack'], processor)
+
+    def testReparsesDotFileNewerThanSnapshot(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'call'):
+            os.mkdir(output + '/dot')
+            processor = self.MakeFirewallProcessor()
+            processor.PrintToPdf('ManInBlack')
+            processor.SaveSnapshot('ManInBlack')
+            processor.graph.AddEdge('antivirus1', 'VPN1')
+            processor.PrintToPdf('ManInBlack')
+            stat = os.stat(plugin.DotFileName('ManInBlack'))
+            os.utime(plugin.DotFileName('ManInBlack'),
+                     ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            with mock.patch.object(plugin.nx_pydot, 'read_dot',
+                                   wraps=plugin.nx_pydot.read_dot) as read_dot:
+                self.assertSameGraph(plugin.LoadProcessor('ManInBlack'), processor)
+                read_dot.assert_called_once()
+                self.assertSameGraph(plugin.LoadProcessor('ManInBlack'), processor)
+                read_dot.assert_called_once()
+
+    def testStartsSystemWithBrokenSnapshotEmpty(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'render_scheduler'), \
+             mock.patch.object(plugin.prof, 'log_warning') as log_warning:
+            os.mkdir(output + '/snapshot')
+            with open(plugin.SnapshotFileName('ManInBlack'), 'wb') as f:
+                f.write(b'garbage')
+            plugin.prof_init(None, None, None, None)
+            plugin.prof_pre_chat_message_display(
+                'darknet@cyberspace', '', 'Current target: ManInBlack\n\nProxy level: 6')
+            self.assertEqual(len(plugin.processors['ManInBlack'].graph), 0)
+            log_warning.assert_called_with(
+                'No usable snapshot or .dot file of ManInBlack, starting it empty')
+
+    def testLoadsProcessorsLazily(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'):
+            self.MakeFirewallProcessor().SaveSnapshot('ManInBlack')
+            with mock.patch.object(plugin, 'LoadProcessor',
+                                   wraps=plugin.LoadProcessor) as load_processor:
+                plugin.prof_init(None, None, None, None)
+                load_processor.assert_not_called()
+                session = plugin.GetSession('darknet@cyberspace')
+                self.assertIn('ManInBlack', plugin.processors)
+                plugin.prof_pre_chat_message_display_no_print(
+                    'darknet@cyberspace', '', 'Current target: ManInBlack\n\nProxy level: 6')
+                self.assertSameGraph(session.GetCurrentProcessor(), self.MakeFirewallProcessor())
+                load_processor.assert_called_once_with('ManInBlack')
+
+    def testEvictsRarelyUsedProcessors(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'):
+            processors = plugin.ProcessorCache(max_loaded=2)
+            processors['ManInBlack'] = self.MakeFirewallProcessor()
+            processors['LadyInRed351'] = plugin.PerSystemProcessor()
+            processors['ManInBlack']
+            processors['BlackMirror944'] = plugin.PerSystemProcessor()
+            self.assertEqual(list(processors.loaded.keys()), ['ManInBlack', 'BlackMirror944'])
+            self.assertTrue(os.path.isfile(plugin.SnapshotFileName('LadyInRed351')))
+            processors['LadyInRed351']
+            self.assertEqual(list(processors.loaded.keys()), ['BlackMirror944', 'LadyInRed351'])
+            self.assertSameGraph(processors['ManInBlack'], self.MakeFirewallProcessor())
+            self.assertEqual(processors.keys(), ['BlackMirror944', 'LadyInRed351', 'ManInBlack'])
+
+    def testRenderKeepsChangesSavedByEviction(self):
+        def PrintToPdf(snapshot, name):
+            # The session changes the graph and evicts it while rendering
+            plugin.processors['ManInBlack'].graph.AddEdge('antivirus1', 'VPN1')
+            plugin.processors['LadyInRed351'] = plugin.PerSystemProcessor()
+            self.assertEqual(list(plugin.processors.loaded.keys()), ['LadyInRed351'])
+            return 0
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'processors', plugin.ProcessorCache(max_loaded=1)), \
+             mock.patch.object(plugin.PerSystemProcessor, 'PrintToPdf', PrintToPdf):
+            plugin.processors['ManInBlack'] = self.MakeFirewallProcessor()
+            plugin.RenderSystem('ManInBlack')
+            self.assertIn(('antivirus1', 'VPN1'), plugin.LoadProcessor('ManInBlack').graph.Edges())
+            self.assertEqual(os.listdir(output + '/snapshot'), ['ManInBlack.pickle'])
+
+    def testWritesRenderedSnapshotOutsideLock(self):
+        locked = []
+        write_snapshot = plugin.WriteSnapshot
+        def TryLock():
+            acquired = plugin.processors_lock.acquire(timeout=1)
+            locked.append(not acquired)
+            if acquired:
+                plugin.processors_lock.release()
+        def WriteSnapshot(name, snapshot):
+            thread = threading.Thread(target=TryLock)
+            thread.start()
+            thread.join()
+            write_snapshot(name, snapshot)
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'WriteSnapshot', WriteSnapshot), \
+             mock.patch.object(plugin.PerSystemProcessor, 'PrintToPdf', return_value=0):
+            plugin.processors['ManInBlack'] = self.MakeFirewallProcessor()
+            plugin.RenderSystem('ManInBlack')
+            self.assertEqual(locked, [False])
+
+    def testKeepsNewestSnapshotWritten(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'):
+            processor = self.MakeFirewallProcessor()
+            older = processor.SnapshotData('ManInBlack')
+            processor.graph.AddEdge('antivirus1', 'VPN1')
+            plugin.WriteSnapshot('ManInBlack', processor.SnapshotData('ManInBlack'))
+            plugin.WriteSnapshot('ManInBlack', older)
+            self.assertSameGraph(plugin.LoadProcessor('ManInBlack'), processor)
+            self.assertEqual(os.listdir(output + '/snapshot'), ['ManInBlack.pickle'])
+
+    def testReadsHistory(self):
+        with tempfile.TemporaryDirectory() as output:
+            with open(output + '/darknet.history', 'w') as f:
+                f.write('|2017-07-14T10:15:53|6|from|N---|subscribed\n'
+                        '|2017-07-14T20:00:39|1|to|N---|target BlackMirror944\n'
+                        '|2017-07-14T20:00:39|1|from|N---|line 1\\nline 2\n'
+                        'line 3 | with pipe\n'
+                        '|2017-07-14T20:00:40|1|from|N---|back\\\\slash\n')
+            self.assertEqual(list(history_processor.ReadHistory(output + '/darknet.history')), [
+                ('from', 'subscribed'),
+                ('to', 'target BlackMirror944'),
+                ('from', 'line 1\nline 2\nline 3 | with pipe'),
+                ('from', 'back\\slash')])
+
+    def testShardsHistoryBySystem(self):
+        program_info = '#1100 programm info:\nEffect: disable\nAllowed node types:\n -VPN\n'
+        events = [
+            ('from', 'subscribed'),
+            ('to', 'target BlackMirror944'),
+            ('from', 'ok'),
+            ('to', 'look firewall'),
+            ('to', 'info 1100'),
+            ('from', program_info),
+            ('from', 'Current target: ManInBlack\n\nProxy level: 6'),
+            ('to', 'look VPN1'),
+            ('from', 'Systems found:\nCitizen121    (firewall: #14510925 )\n'),
+        ]
+        stats = {'events': 0, 'skipped': 0}
+        shards, programs = history_processor.ShardBySystem(events, stats)
+        self.assertEqual(list(shards.keys()), ['BlackMirror944', 'ManInBlack', 'Citizen121'])
+        self.assertEqual(shards['Citizen121'], shards['ManInBlack'][-1:])
+        self.assertEqual(shards['BlackMirror944'], [
+            ('from', 'ok'), ('to', 'look firewall'), ('to', 'info 1100')])
+        self.assertEqual([p.program for p in programs], [1100])
+        self.assertEqual(stats, {'events': 9, 'skipped': 2})
+
+    def testPrintsOnlyChangedPdfs(self):
+        def dot(args):
+            if 'Broken' in args[1]:
+                return 1
+            open(args[3][2:], 'w').close()
+            return 0
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'call', side_effect=dot):
+            os.mkdir(output + '/dot')
+            self.MakeSession(None)
+            processors = plugin.processors
+            processors['ManInBlack'] = self.MakeFirewallProcessor()
+            processors['LadyInRed351'] = self.MakeFirewallProcessor()
+            processors['Broken'] = self.MakeFirewallProcessor()
+            results = plugin.PrintAllPdfs()
+            self.assertEqual([(r.system, r.status) for r in results], [
+                ('Broken', 'failed'), ('LadyInRed351', 'rendered'), ('ManInBlack', 'rendered')])
+            self.assertEqual(results[0].error, 'dot exited with code 1')
+            processors['ManInBlack'].graph.AddEdge('antivirus1', 'VPN1')
+            results = plugin.PrintAllPdfs()
+            self.assertEqual([(r.system, r.status) for r in results], [
+                ('Broken', 'failed'), ('LadyInRed351', 'unchanged'), ('ManInBlack', 'rendered')])
+
+    def testPrintsSavedPdfsBeforeAnySession(self):
+        def dot(args):
+            open(args[3][2:], 'w').close()
+            return 0
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'call', side_effect=dot):
+            os.mkdir(output + '/dot')
+            self.MakeFirewallProcessor().SaveSnapshot('ManInBlack')
+            plugin.prof_init(None, None, None, None)
+            results = plugin.PrintAllPdfs()
+            self.assertEqual([(r.system, r.status) for r in results], [('ManInBlack', 'rendered')])
+            self.assertEqual(plugin.AllSessions(), [])
+
+    def testPrintsPdfsWithoutCopyingUnchangedSystems(self):
+        def dot(args):
+            open(args[3][2:], 'w').close()
+            return 0
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'call', side_effect=dot):
+            os.mkdir(output + '/dot')
+            names = ['LadyInRed351', 'ManInBlack', 'Citizen121']
+            for name in names:
+                self.MakeFirewallProcessor().SaveSnapshot(name)
+            plugin.processors = plugin.ProcessorCache(names, max_loaded=1)
+            results = plugin.PrintAllPdfs(max_workers=1)
+            self.assertEqual([r.status for r in results], ['rendered'] * 3)
+            self.assertEqual(len(plugin.processors.loaded), 1)
+            with mock.patch.object(plugin.PerSystemProcessor, 'Snapshot') as snapshot:
+                results = plugin.PrintAllPdfs(max_workers=1)
+            self.assertEqual([r.status for r in results], ['unchanged'] * 3)
+            snapshot.assert_not_called()
+
+    def testWritesDot(self):
+        processor = self.MakeFirewallProcessor()
+        processor.OnNodeInfo(plugin.NodeInfo('antivirus1', 1811628, 'Antivirus', False, 'trace', [
+            plugin.MakeChildNodeInfo('VPN1', None, 'VPN', False)]))
+        with tempfile.TemporaryDirectory() as output:
+            with open(output + '/ManInBlack.dot', 'w') as f:
+                processor.WriteDot(f)
+            with open(output + '/ManInBlack.dot') as f:
+                self.assertEqual(f.read(), '''strict digraph {
+firewall [program=2209900, disabled=True, effect=NoOp, node_type=Firewall, label="firewall\\n2209900", style=dotted];
+antivirus1 [program=1811628, disabled=False, effect=trace, node_type=Antivirus, label="antivirus1\\n1811628", style=bold];
+antivirus2 [disabled=True, node_type=Antivirus, label="antivirus2\\n???", style=dotted];
+VPN1 [disabled=False, node_type=VPN, label="VPN1\\n???", style=""];
+firewall -> antivirus1;
+firewall -> antivirus2;
+antivirus1 -> VPN1;
+}
+''')
+            loaded = plugin.PerSystemProcessor(
+                plugin.GraphFromDot(output + '/ManInBlack.dot'))
+            self.assertSameGraph(loaded, processor)
+
+    def testQuotesDotIds(self):
+        self.assertEqual(plugin.DotId('firewall'), 'firewall')
+        self.assertEqual(plugin.DotId(2209900), '2209900')
+        self.assertEqual(plugin.DotId('node'), '"node"')
+        self.assertEqual(plugin.DotId('Traffic monitor'), '"Traffic monitor"')
+        self.assertEqual(plugin.DotId('VPN "1"\n#2'), '"VPN \\"1\\"\\n#2"')
+
+    # Fakes graphviz -Tplain output, placing nodes in a row in the order
+    # they appear in the dot file
+    def FakeLayout(self, args):
+        if args[2] == '-Tplain':
+            with open(args[1]) as f:
+                names = re.findall(r'^(\S+) \[', f.read(), re.M)
+            with open(args[3][2:], 'w') as f:
+                f.write('graph 1 10 2\n')
+                for i, name in enumerate(names):
+                    f.write('node %s %d 1 0.75 0.5 label ellipse black lightgrey\n' % (name, i))
+                f.write('stop\n')
+        return 0
+
+    def testPrintsSvg(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'RENDER_FORMAT', 'svg'), \
+             mock.patch.object(plugin, 'call', side_effect=self.FakeLayout) as call:
+            os.mkdir(output + '/dot')
+            self.MakeFirewallProcessor().PrintToPdf('ManInBlack')
+            self.assertEqual(call.call_args_list, [
+                mock.call(['dot', output + '/dot/ManInBlack.dot', '-Tplain',
+                           '-o' + output + '/dot/ManInBlack.plain']),
+                mock.call(['neato', output + '/dot/ManInBlack.dot', '-Tsvg',
+                           '-o' + output + '/ManInBlack.svg', '-n2'])])
+
+    def testLaysOutOnlyNewNodes(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'call', side_effect=self.FakeLayout) as call:
+            os.mkdir(output + '/dot')
+            processor = self.MakeFirewallProcessor()
+            processor.PrintToPdf('ManInBlack')
+            self.assertEqual(processor.positions, {
+                'firewall': (0.0, 1.0), 'antivirus1': (1.0, 1.0), 'antivirus2': (2.0, 1.0)})
+            with open(plugin.DotFileName('ManInBlack')) as f:
+                self.assertIn('pos="72.00,72.00!"', f.read())
+            call.reset_mock()
+            processor.OnNodeInfo(plugin.NodeInfo('antivirus1', 1811628, 'Antivirus', False, 'NoOp', [
+                plugin.MakeChildNodeInfo('VPN1', None, 'VPN', False)]))
+            processor.PrintToPdf('ManInBlack')
+            self.assertEqual([c[0][0][0] for c in call.call_args_list], ['neato', 'neato'])
+            self.assertEqual(call.call_args_list[0][0][0][2], '-Tplain')
+            self.assertEqual(processor.positions['firewall'], (0.0, 1.0))
+            self.assertIn('VPN1', processor.positions)
+            call.reset_mock()
+            processor.PrintToPdf('ManInBlack')
+            self.assertEqual(call.call_count, 1)
+            processor.SaveSnapshot('ManInBlack')
+            self.assertEqual(plugin.LoadProcessor('ManInBlack').positions, processor.positions)
+
+    def MakePlanningProcessor(self):
+        processor = plugin.PerSystemProcessor()
+        processor.OnNodeInfo(plugin.NodeInfo('firewall', 6449300, 'Firewall', True, 'NoOp', [
+            plugin.MakeChildNodeInfo('antivirus1', 1208700, 'Antivirus', False),
+            plugin.MakeChildNodeInfo('antivirus2', 2739100, 'Antivirus', True)]))
+        processor.OnNodeInfo(plugin.NodeInfo('antivirus1', 1208700, 'Antivirus', False, 'NoOp', [
+            plugin.MakeChildNodeInfo('VPN3', 7993700, 'VPN', False),
+            plugin.MakeChildNodeInfo('cryptocore3', None, 'Cyptographic system', False)]))
+        processor.OnNodeInfo(plugin.NodeInfo('antivirus2', 2739100, 'Antivirus', True, 'NoOp', [
+            plugin.MakeChildNodeInfo('brandmauer3', 2294523, 'Brandmauer', False)]))
+        processor.OnNodeInfo(plugin.NodeInfo('brandmauer3', 2294523, 'Brandmauer', False, 'NoOp', [
+            plugin.MakeChildNodeInfo('VPN3', 7993700, 'VPN', False)]))
+        return processor
+
+    def testPlansCheapestAttack(self):
+        index = plugin.AttackIndex([
+            plugin.ProgramInfoParsed(180, 'disable', None, ['Antivirus'], 600),
+            plugin.ProgramInfoParsed(1100, 'disable', None, ['VPN', 'Antivirus'], 600),
+            plugin.ProgramInfoParsed(4851, 'disable', None, ['Brandmauer'], 600)])
+        with mock.patch.object(plugin, 'attack_index', index):
+            processor = self.MakePlanningProcessor()
+            self.assertEqual(plugin.PlanAttack(processor, 'VPN3'), [
+                plugin.PlanStep('firewall', None),
+                plugin.PlanStep('antivirus1', 180),
+                plugin.PlanStep('VPN3', 1100)])
+            processor.graph.nodes['antivirus1'].program = 1
+            self.assertEqual(plugin.PlanAttack(processor, 'VPN3'), [
+                plugin.PlanStep('firewall', None),
+                plugin.PlanStep('antivirus2', None),
+                plugin.PlanStep('brandmauer3', 4851),
+                plugin.PlanStep('VPN3', 1100)])
+            self.assertIsNone(plugin.PlanAttack(processor, 'cryptocore3'))
+            self.assertIsNone(plugin.PlanAttack(processor, 'VPN42'))
+
+    def testPlansOnlyFromFirewall(self):
+        index = plugin.AttackIndex([
+            plugin.ProgramInfoParsed(1100, 'disable', None, ['VPN'], 600)])
+        with mock.patch.object(plugin, 'attack_index', index):
+            processor = plugin.PerSystemProcessor()
+            processor.OnNodeAttacked(plugin.NodeAttacked('ManInBlack', 'VPN3', 7993700, None))
+            processor.graph.nodes['VPN3'].node_type = 'VPN'
+            # Without a firewall nodes nobody points to are the entries
+            self.assertEqual(plugin.PlanAttack(processor, 'VPN3'), [plugin.PlanStep('VPN3', 1100)])
+            processor.OnSystemFound(plugin.SystemFound('ManInBlack', 6449300))
+            self.assertIsNone(plugin.PlanAttack(processor, 'VPN3'))
+            self.assertEqual(processor.ReachableNodes(), ['firewall'])
+            processor.graph.AddEdge('firewall', 'VPN3')
+            processor.graph.nodes['firewall'].disabled = True
+            self.assertEqual(plugin.PlanAttack(processor, 'VPN3'), [
+                plugin.PlanStep('firewall', None), plugin.PlanStep('VPN3', 1100)])
+
+    def testExpiresDisabledNodes(self):
+        processor = self.MakePlanningProcessor()
+        self.assertEqual(processor.ReachableNodes(0), [
+            'firewall', 'antivirus1', 'antivirus2', 'brandmauer3'])
+        processor.DisableFor('antivirus1', 600, now=0)
+        processor.DisableFor('antivirus2', 300, now=0)
+        self.assertEqual(processor.ReachableNodes(0), [
+            'firewall', 'antivirus1', 'antivirus2', 'VPN3', 'cryptocore3', 'brandmauer3'])
+        self.assertEqual(processor.ReachableNodes(400), [
+            'firewall', 'antivirus1', 'antivirus2', 'VPN3', 'cryptocore3'])
+        processor.DisableFor('antivirus1', 600, now=100)
+        self.assertEqual(processor.ExpireDisabled(299), [])
+        self.assertEqual(processor.ExpireDisabled(600), ['antivirus2'])
+        self.assertEqual(processor.ExpireDisabled(700), ['antivirus1'])
+        self.assertFalse(processor.graph.nodes['antivirus1'].disabled)
+        self.assertEqual(processor.expiries, [])
+        processor.DisableFor('antivirus2', 300, now=1000)
+        self.assertEqual(plugin.PerSystemProcessor(processor.graph.Copy()).expiries,
+                         [(1300, 'antivirus2')])
+        self.assertEqual(plugin.FormatReachable(processor, 1100),
+                         'Reachable nodes: firewall (disabled), antivirus1, '
+                         'antivirus2 (disabled for 200 sec), brandmauer3')
+
+    def testExpiryTickRendersOnlyExpiredSystems(self):
+        with mock.patch.object(plugin, 'render_scheduler') as scheduler, \
+             mock.patch.object(plugin.time, 'time', return_value=1000.0):
+            session = self.MakeSession('ManInBlack', self.MakeFirewallProcessor())
+            plugin.processors['LadyInRed351'] = self.MakeFirewallProcessor()
+            session.OnMessage('executing program #2420 from willy220 target:ManInBlack \n'
+                              'Node defence: #1811628\nattack successfull\n'
+                              "Node 'antivirus1' disabled for 600 seconds.")
+            session.updated_systems.clear()
+            node = plugin.processors['ManInBlack'].graph.nodes['antivirus1']
+            self.assertEqual(node.disabled_until, 1600.0)
+            plugin.ExpiryTick()
+            scheduler.MarkDirty.assert_not_called()
+            plugin.time.time.return_value = 1600.0
+            plugin.ExpiryTick()
+            scheduler.MarkDirty.assert_called_once_with('ManInBlack')
+            self.assertFalse(node.disabled)
+
+    def testFormatsPlan(self):
+        self.assertEqual(plugin.FormatPlan('VPN3', [
+            plugin.PlanStep('firewall', None),
+            plugin.PlanStep('antivirus1', 180),
+            plugin.PlanStep('VPN3', 700)]),
+            '2 attacks to reach VPN3: firewall (disabled) -> antivirus1 (#180) -> VPN3 (#700)')
+        self.assertEqual(plugin.FormatPlan('VPN3', None), 'No known way to reach VPN3')
+
+    def PatchAutoattack(self, bot, processor, **kwargs):
+        self.now = 0.0
+        self.session = self.MakeSession(bot.system, processor)
+        attacker = plugin.AutoAttacker(bot.Send, clock=lambda: self.now,
+                                       pending_attacks=self.session.pending_attacks, **kwargs)
+        self.session.autoattacker = attacker
+        index = plugin.AttackIndex([
+            plugin.ProgramInfoParsed(180, 'disable', None, ['Antivirus'], 600),
+            plugin.ProgramInfoParsed(1100, 'disable', None, ['VPN', 'Antivirus'], 600),
+            plugin.ProgramInfoParsed(4851, 'disable', None, ['Brandmauer'], 600)])
+        patch = mock.patch.object(plugin, 'attack_index', index)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return attacker
+
+    def testAutoattacksAlongPlan(self):
+        bot = FakeBot('BlackMirror944', {'antivirus1': 1208700, 'VPN3': 7993700})
+        attacker = self.PatchAutoattack(bot, self.MakePlanningProcessor(), min_interval=0)
+        plugin.CmdAutoattack('VPN3')
+        self.assertEqual(bot.commands, ['#180 antivirus1'])
+        bot.Reply()
+        self.assertEqual(bot.commands, ['#180 antivirus1', '#1100 VPN3'])
+        bot.Reply()
+        self.assertTrue(attacker.IsIdle())
+        self.assertEqual(attacker.done, set(['antivirus1', 'VPN3']))
+
+    def testAutoattackKeepsSeveralAttacksInFlight(self):
+        bot = FakeBot('BlackMirror944', {'antivirus1': 1208700, 'brandmauer3': 2294523,
+                                         'VPN3': 7993700})
+        processor = self.MakePlanningProcessor()
+        attacker = self.PatchAutoattack(bot, processor, min_interval=1.0, max_in_flight=2)
+        plugin.CmdAutoattack('antivirus1')
+        plugin.CmdAutoattack('brandmauer3')
+        self.assertEqual(bot.commands, ['#180 antivirus1'])
+        self.now = 0.5
+        plugin.AutoattackTick()
+        self.assertEqual(len(bot.commands), 1)
+        self.now = 1.0
+        plugin.AutoattackTick()
+        self.assertEqual(bot.commands, ['#180 antivirus1', '#4851 brandmauer3'])
+        self.assertEqual(len(attacker.in_flight), 2)
+        processor.graph.nodes['antivirus1'].program = None
+        processor.graph.nodes['brandmauer3'].program = None
+        bot.Reply()
+        bot.Reply()
+        self.assertEqual(processor.graph.nodes['antivirus1'].program, 1208700)
+        self.assertEqual(processor.graph.nodes['brandmauer3'].program, 2294523)
+        self.assertTrue(attacker.IsIdle())
+
+    def testAutoattackDropsDependentAttacksOnFailure(self):
+        bot = FakeBot('BlackMirror944', {'antivirus1': 1208701, 'VPN3': 7993700})
+        attacker = self.PatchAutoattack(bot, self.MakePlanningProcessor(), min_interval=0)
+        plugin.CmdAutoattack('VPN3')
+        bot.Reply()
+        self.assertEqual(bot.commands, ['#180 antivirus1'])
+        self.assertTrue(attacker.IsIdle())
+        self.assertEqual(attacker.done, set())
+
+    def testAutoattackTreatsDisabledNodeAsDone(self):
+        bot = FakeBot('BlackMirror944', {'antivirus1': 1208700, 'VPN3': 7993700})
+        bot.disabled.add('antivirus1')
+        attacker = self.PatchAutoattack(bot, self.MakePlanningProcessor(), min_interval=0)
+        plugin.CmdAutoattack('VPN3')
+        bot.Reply()
+        self.assertEqual(bot.commands, ['#180 antivirus1', '#1100 VPN3'])
+
+    def testAutoattackGivesUpWithoutReply(self):
+        bot = FakeBot('BlackMirror944', {'antivirus1': 1208700, 'VPN3': 7993700})
+        attacker = self.PatchAutoattack(bot, self.MakePlanningProcessor(), min_interval=0,
+                                        timeout=10)
+        plugin.CmdAutoattack('VPN3')
+        self.now = 11
+        plugin.AutoattackTick()
+        self.assertTrue(attacker.IsIdle())
+        self.assertEqual(self.session.pending_attacks.nodes, {})
+
+    def testCorrelatesAttackRepliesWithCommands(self):
+        bot = FakeBot('BlackMirror944', {'antivirus1': 1208700, 'antivirus2': 2739100})
+        processor = self.MakePlanningProcessor()
+        self.PatchAutoattack(bot, processor)
+        processor.graph.nodes['antivirus1'].program = None
+        processor.graph.nodes['antivirus2'].program = None
+        bot.Send('#180 antivirus1')
+        bot.Send('#700 antivirus2')
+        bot.Reply()
+        bot.Reply()
+        self.assertEqual(processor.graph.nodes['antivirus1'].program, 1208700)
+        self.assertEqual(processor.graph.nodes['antivirus2'].program, 2739100)
+
+    def testQueriesAttacksByDefenseProgram(self):
+        index = plugin.AttackIndex([
+            plugin.ProgramInfoParsed(700, 'disable', None, ['Firewall', 'VPN'], 600),
+            plugin.ProgramInfoParsed(1100, 'disable', None, ['Cyptographic system'], 600),
+            plugin.ProgramInfoParsed(3, 'disable', None, ['Firewall'], 600)])
+        with mock.patch.object(plugin, 'attack_index', index), \
+             mock.patch.object(plugin.prof, 'cons_show') as cons_show:
+            plugin.CmdQuery('defense', '#2209900')
+            cons_show.assert_called_with('Attacks against #2209900: '
+                                         '700:disable (Firewall, VPN), '
+                                         '1100:disable (Cyptographic system)')
+            plugin.CmdQuery('defense', '7')
+            cons_show.assert_called_with('Attacks against #7: none known')
+
+    def testQueriesObservedDefenses(self):
+        bot = FakeBot('BlackMirror944', {'antivirus1': 1208700, 'antivirus2': 2739100})
+        self.PatchAutoattack(bot, self.MakePlanningProcessor())
+        bot.Send('#180 antivirus1')
+        bot.Send('#180 antivirus2')
+        bot.Reply()
+        bot.Reply()
+        with mock.patch.object(plugin.prof, 'cons_show') as cons_show:
+            plugin.CmdQuery('attack', '180')
+            cons_show.assert_called_with('Defenses seen for #180: #1208700, #2739100')
+            plugin.CmdQuery('attack', '700')
+            cons_show.assert_called_with('Defenses seen for #700: none')
+            plugin.CmdQuery('program', 'x')
+            cons_show.assert_called_with('Usage: /query defense|attack <program>')
+
+    def testLearnsAttackOutcomes(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'):
+            plugin.prof_init(None, None, None, None)
+            plugin.LearnProgram(plugin.ProgramInfoParsed(1100, 'disable', None, ['Firewall'], 600))
+            plugin.LearnProgram(plugin.ProgramInfoParsed(700, 'disable', None, ['Firewall'], 600))
+            self.assertEqual(plugin.MakeHackTooltip(2209900, 'Firewall'),
+                             '(700:disable, 1100:disable)')
+            session = self.MakeSession('ManInBlack', self.MakeFirewallProcessor())
+            session.OnSend('#1100 firewall')
+            session.OnMessage('executing program #1100 from willy220 target:ManInBlack \n'
+                              'Node defence: #2209900\nattack failed\n')
+            session.OnSend('#5 firewall')
+            session.OnMessage('executing program #5 from willy220 target:ManInBlack \n'
+                              'Node defence: #2209900\nattack successfull\n'
+                              "Node 'firewall' disabled for 600 seconds.")
+            self.assertEqual(plugin.MakeHackTooltip(2209900, 'Firewall'),
+                             '(5:? verified, 700:disable)')
+            report = ['2 attack outcomes seen, 2 verified pairs',
+                      'TheRule disagrees with 1 of them (50%), 1 pairs still disagree',
+                      '#1100 against #2209900: failed']
+            self.assertEqual(plugin.FormatOutcomes(plugin.attack_outcomes), report)
+            plugin.OutcomesTick()
+            with open(plugin.OutcomesFileName()) as f:
+                self.assertEqual(f.readlines(), ['[1100, 2209900, "Firewall", false]\n',
+                                                 '[5, 2209900, "Firewall", true]\n'])
+            plugin.prof_init(None, None, None, None)
+            self.assertEqual(plugin.FormatOutcomes(plugin.attack_outcomes), report)
+            self.assertEqual(plugin.FormatAttackQuery(1100), 'Defenses seen for #1100: #2209900')
+
+    def testTooltipFollowsIndexAndNodeType(self):
+        with mock.patch.object(plugin, 'attack_index', plugin.AttackIndex()), \
+             mock.patch.object(plugin, 'hack_tooltips', dict()):
+            plugin.attack_outcomes.Record(plugin.AttackOutcome(5, 2209900, 'Firewall', True))
+            plugin.attack_outcomes.Record(plugin.AttackOutcome(7, 2209900, 'VPN', True))
+            self.assertEqual(plugin.MakeHackTooltip(2209900, 'Firewall'), '(5:? verified)')
+            plugin.attack_index.Add(plugin.ProgramInfoParsed(5, 'disable', None, ['Firewall'], 600))
+            self.assertEqual(plugin.MakeHackTooltip(2209900, 'Firewall'), '(5:disable verified)')
+            self.assertEqual(plugin.MakeHackTooltip(2209900, 'VPN'), '(7:? verified)')
+            plugin.attack_outcomes.Record(plugin.AttackOutcome(11, 2209900, None, True))
+            plugin.attack_index.Add(plugin.ProgramInfoParsed(11, 'trace', None, ['VPN'], 600))
+            self.assertEqual(plugin.MakeHackTooltip(2209900, 'Firewall'), '(5:disable verified)')
+            self.assertEqual(plugin.MakeHackTooltip(2209900, 'VPN'),
+                             '(7:? verified, 11:trace verified)')
+
+    def testRecordsAttackOnNodeNeverLookedAt(self):
+        with mock.patch.object(plugin, 'render_scheduler'):
+            plugin.prof_pre_chat_message_send('darknet@cyberspace', 'target ManInBlack')
+            plugin.prof_pre_chat_message_display('darknet@cyberspace', '', 'ok')
+            plugin.prof_pre_chat_message_send('darknet@cyberspace', '#180 VPN9')
+            plugin.prof_pre_chat_message_display(
+                'darknet@cyberspace', '', 'executing program #180 from willy220 '
+                'target:ManInBlack \nNode defence: #2209900\nattack failed\n')
+        self.assertEqual(plugin.processors['ManInBlack'].graph.nodes['VPN9'].program, 2209900)
+        self.assertEqual(plugin.attack_outcomes.Verified(2209900), {180: False})
+
+    def testCrawlsSystem(self):
+        bot = HistoryBot('example.history', 'BlackMirror944')
+        known_program = plugin.ProgramInfoParsed(1208700, 'trace', None, ['Antivirus'], None)
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'known_programs', {1208700: known_program}), \
+             mock.patch.object(plugin, 'attack_index', plugin.AttackIndex()), \
+             mock.patch.object(plugin, 'render_scheduler'), \
+             mock.patch.object(plugin.prof, 'send_line', side_effect=bot.SendLine), \
+             mock.patch.object(plugin.prof, 'cons_show') as cons_show:
+            session = self.MakeSession('BlackMirror944')
+            crawler = plugin.Crawler(session.Send, 'BlackMirror944', window=3, min_interval=0,
+                                     timeout=5)
+            session.crawler = crawler
+            crawler.Start()
+            # Stands in for the client's timer
+            deadline = time.monotonic() + 10
+            while session.crawler is not None and time.monotonic() < deadline:
+                plugin.CrawlTick()
+                time.sleep(0.001)
+            self.assertTrue(crawler.done.is_set())
+            self.assertIsNone(session.crawler)
+            cons_show.assert_called_once_with(
+                'Crawled BlackMirror944: 22 nodes looked at, 2 not available (VPN6, datastorage1), '
+                '9 of 20 programs found, 0 queries timed out')
+            self.assertEqual(bot.send_threads, {threading.main_thread()})
+            self.assertEqual(bot.commands[:4], [
+                'look firewall', 'info 6449300', 'look antivirus1', 'look antivirus2'])
+            self.assertEqual(len(bot.commands), len(set(bot.commands)))
+            self.assertNotIn('info 1208700', bot.commands)
+            self.assertLessEqual(bot.max_in_flight, 3)
+            graph = plugin.processors['BlackMirror944'].graph
+            self.assertEqual(len(graph), 24)
+            self.assertEqual(graph.nodes['VPN4'].program, 2209900)
+            self.assertIn(2209900, plugin.known_programs)
+
+    def testStopsCrawl(self):
+        with mock.patch.object(plugin.prof, 'send_line') as send_line, \
+             mock.patch.object(plugin.prof, 'cons_show') as cons_show:
+            plugin.CmdCrawl()
+            cons_show.assert_called_with('Target is not set')
+            session = self.MakeSession('BlackMirror944')
+            plugin.CmdCrawl()
+            cons_show.assert_called_with('Crawling BlackMirror944')
+            crawler = session.crawler
+            plugin.CmdCrawl()
+            cons_show.assert_called_with('Already crawling BlackMirror944')
+            plugin.CmdCrawl('stop')
+            self.assertTrue(crawler.done.is_set())
+            self.assertIsNone(session.crawler)
+            cons_show.assert_called_with('Crawl of BlackMirror944 stopped')
+            send_line.assert_not_called()
+
+    def testCrawlerSendsAtMostOneCommandPerInterval(self):
+        sent = []
+        now = [0.0]
+        crawler = plugin.Crawler(sent.append, 'ManInBlack', min_interval=1.0, clock=lambda: now[0])
+        crawler.outbox.extend(['look firewall', 'info 1100'])
+        crawler.Pump()
+        now[0] = 0.5
+        crawler.Pump()
+        self.assertEqual(sent, ['look firewall'])
+        now[0] = 1.0
+        crawler.Pump()
+        self.assertEqual(sent, ['look firewall', 'info 1100'])
+
+    def testCrawlerSendsCommandsDueSincePreviousTick(self):
+        sent = []
+        now = [0.0]
+        crawler = plugin.Crawler(sent.append, 'ManInBlack', min_interval=0.25, clock=lambda: now[0])
+        crawler.outbox.extend('look node%d' % i for i in range(20))
+        crawler.Pump()
+        self.assertEqual(len(sent), 1)
+        now[0] = 1.0
+        crawler.Pump()
+        self.assertEqual(len(sent), 5)
+        now[0] = 60.0
+        crawler.Pump()
+        self.assertEqual(len(sent), 9)
+
+    def testCollectsStatsOnlyWhenEnabled(self):
+        with mock.patch.object(plugin, 'stats', plugin.Stats(window=2)):
+            plugin.ParseIncomingMessage('ok')
+            self.assertEqual(plugin.stats.Format(), [])
+            plugin.CmdStats('on')
+            for _ in range(3):
+                plugin.ParseIncomingMessage('ok')
+            self.assertEqual(plugin.stats.counts, {'parse': 3})
+            self.assertEqual(len(plugin.stats.samples['parse']), 2)
+            with mock.patch.object(plugin.prof, 'cons_show') as cons_show:
+                plugin.CmdStats()
+                self.assertEqual(cons_show.call_args_list[0], mock.call('Instrumentation is on'))
+                self.assertTrue(cons_show.call_args[0][0].startswith('parse: 3 calls, '))
+            plugin.CmdStats('reset')
+            self.assertEqual(plugin.stats.Format(), [])
+
+    def testProfilesMessages(self):
+        with mock.patch.object(plugin, 'stats', plugin.Stats()), \
+             mock.patch.object(plugin, 'render_scheduler'), \
+             mock.patch.object(plugin.prof, 'log_info') as log_info:
+            plugin.CmdStats('profile', '2')
+            plugin.prof_pre_chat_message_display('darknet@cyberspace', '', 'ok')
+            self.assertIsNotNone(plugin.stats.profiler)
+            plugin.prof_pre_chat_message_display('darknet@cyberspace', '', '403 Forbidden')
+            self.assertIsNone(plugin.stats.profiler)
+            self.assertIn('prof_pre_chat_message_display_no_print', log_info.call_args[0][0])
+
+    def testIsolatesSessions(self):
+        bots = ['darknet@cyberspace', 'raven@jabber.alice.digital']
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'):
+            plugin.prof_init(None, None, 'willy220', None)
+            plugin.prof_pre_chat_message_display_no_print(
+                bots[0], '', 'Current target: ManInBlack\n\nProxy level: 6')
+            plugin.prof_pre_chat_message_display_no_print(
+                bots[1], '', 'Current target: Citizen121\n\nProxy level: 2')
+            plugin.prof_on_connect('trinity342', None)
+            plugin.prof_pre_chat_message_display_no_print(
+                bots[0], '', '#1100 programm info:\nEffect: disable\nAllowed node types:\n -VPN\n')
+            self.assertEqual(sorted(plugin.sessions.keys()), [
+                ('trinity342', bots[0]), ('willy220', bots[0]), ('willy220', bots[1])])
+            self.assertEqual(plugin.sessions[('willy220', bots[0])].current_system, 'ManInBlack')
+            self.assertEqual(plugin.sessions[('willy220', bots[1])].proxy_level, 2)
+            self.assertIsNone(plugin.sessions[('trinity342', bots[0])].current_system)
+            self.assertEqual(list(plugin.known_programs.keys()), [1100])
+
+    def testHandlesSessionsConcurrently(self):
+        node_info = ('\n--------------------\nNode "%s/firewall" properties:\n'
+                     'Installed program: #%d\nType: Firewall\nChild nodes:\n'
+                     '0: antivirus%d (Antivirus): #%d \n\nEND ----------------')
+        def Run(bot_jid, system, count):
+            for i in range(count):
+                plugin.prof_pre_chat_message_send(bot_jid, 'look firewall')
+                plugin.prof_pre_chat_message_display_no_print(
+                    bot_jid, '', node_info % (system, 1000 + i, i, 2000 + i))
+        # Both sessions have to be inside the hook at the same time to pass
+        barrier = threading.Barrier(2, timeout=5)
+        make_hack_tooltip = plugin.MakeHackTooltip
+        def MakeHackTooltip(*args):
+            barrier.wait()
+            return make_hack_tooltip(*args)
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'MakeHackTooltip', MakeHackTooltip):
+            plugin.prof_init(None, None, None, None)
+            threads = [threading.Thread(target=Run, args=('darknet@cyberspace', 'ManInBlack', 200)),
+                       threading.Thread(target=Run, args=('raven@jabber.alice.digital',
+                                                          'Citizen121', 200))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertFalse(barrier.broken)
+            self.assertEqual(list(plugin.processors.keys()), ['Citizen121', 'ManInBlack'])
+            for system in ['ManInBlack', 'Citizen121']:
+                graph = plugin.processors[system].graph
+                self.assertEqual(graph.nodes['firewall'].program, 1199)
+                self.assertEqual(len(graph.Childs('firewall')), 200)
+
+    def testTeamStoreKeepsFreshestNodes(self):
+        with tempfile.TemporaryDirectory() as output:
+            first = plugin.TeamStore(output + '/team.sqlite')
+            second = plugin.TeamStore(output + '/team.sqlite')
+            program_info = plugin.ProgramInfoParsed(1100, 'disable', None, ['VPN'], 600)
+            first.PushProgram(program_info, 10.0)
+            first.PushNode('ManInBlack', 'firewall', (2209900, True, False, None, 'Firewall'), 10.0)
+            first.PushEdge('ManInBlack', 'firewall', 'antivirus1')
+            first.Flush()
+            seq, programs, nodes, edges = second.Pull(0)
+            self.assertEqual(programs, [program_info])
+            self.assertEqual(nodes, [('ManInBlack', 'firewall',
+                                      (2209900, True, False, None, 'Firewall'), 10.0)])
+            self.assertEqual(edges, [('ManInBlack', 'firewall', 'antivirus1')])
+            second.PushNode('ManInBlack', 'firewall', (2209900, False, False, None, 'Firewall'), 5.0)
+            second.Flush()
+            self.assertEqual(first.Pull(seq)[1:], ([], [], []))
+            second.PushNode('ManInBlack', 'firewall', (2209900, False, False, None, 'Firewall'), 20.0)
+            second.Flush()
+            self.assertEqual(first.Pull(seq)[1:], ([], [('ManInBlack', 'firewall',
+                                                         (2209900, False, False, None, 'Firewall'),
+                                                         20.0)], []))
+            first.Close()
+            second.Close()
+
+    def testSharesKnowledgeThroughTeamStore(self):
+        node_info = ('\n--------------------\nNode "ManInBlack/firewall" properties:\n'
+                     'Installed program: #2209900\nType: Firewall\nChild nodes:\n'
+                     '0: antivirus1 (Antivirus): #1208700 \n\nEND ----------------')
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'TEAM_STORE_LOCATION', output + '/team.sqlite'), \
+             mock.patch.object(plugin, 'render_scheduler'):
+            plugin.prof_init(None, None, 'willy220', None)
+            teammate = plugin.TeamStore(output + '/team.sqlite')
+            teammate.PushProgram(plugin.ProgramInfoParsed(1100, 'disable', None, ['VPN'], 600), 1.0)
+            teammate.Flush()
+            plugin.prof_pre_chat_message_display('darknet@cyberspace', '', node_info)
+            plugin.prof_on_connect('trinity342', None)
+            plugin.TeamSyncTick()
+            self.assertIn(1100, plugin.known_programs)
+            graph = plugin.processors['ManInBlack'].graph
+            self.assertEqual(graph.nodes['firewall'].program, 2209900)
+            self.assertEqual(list(graph.Edges()), [('firewall', 'antivirus1')])
+            self.assertEqual([node for _, node, _, _ in teammate.Pull(0)[2]], ['firewall', 'antivirus1'])
+            plugin.team_store.Close()
+            teammate.Close()
+
+    def testTeamSyncKeepsFresherNodes(self):
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'TEAM_STORE_LOCATION', output + '/team.sqlite'), \
+             mock.patch.object(plugin, 'render_scheduler') as scheduler:
+            processor = self.MakeFirewallProcessor()
+            processor.StampChanges(100.0)
+            processor.SaveSnapshot('ManInBlack')
+            teammate = plugin.TeamStore(output + '/team.sqlite')
+            teammate.PushNode('ManInBlack', 'firewall', (2209900, False, False, None, None, None), 50.0)
+            teammate.PushNode('ManInBlack', 'antivirus1', (1811628, True, False, None, None, None), 200.0)
+            teammate.PushNode('ManInBlack', 'VPN1', (None, False, False, None, None, None), 200.0)
+            teammate.Flush()
+            # No session has looked at the system yet
+            plugin.prof_init(None, None, 'willy220', None)
+            plugin.TeamSyncTick()
+            scheduler.MarkDirty.assert_called_once_with('ManInBlack')
+            nodes = plugin.processors['ManInBlack'].graph.nodes
+            self.assertTrue(nodes['firewall'].disabled)
+            self.assertTrue(nodes['antivirus1'].disabled)
+            self.assertIn('VPN1', nodes)
+            self.assertEqual({node: (fields[1], updated)
+                              for _, node, fields, updated in teammate.Pull(0)[2]},
+                             {'firewall': (True, 100.0), 'antivirus1': (True, 200.0),
+                              'antivirus2': (True, 100.0), 'VPN1': (False, 200.0)})
+            plugin.team_store.Close()
+            teammate.Close()
+
+    def testPushesToTeamOnShutdown(self):
+        node_info = ('\n--------------------\nNode "ManInBlack/firewall" properties:\n'
+                     'Installed program: #2209900\nType: Firewall\n\nEND ----------------')
+        with tempfile.TemporaryDirectory() as output, \
+             mock.patch.object(plugin, 'OUTPUT_LOCATION', output + '/'), \
+             mock.patch.object(plugin, 'TEAM_STORE_LOCATION', output + '/team.sqlite'), \
+             mock.patch.object(plugin, 'render_scheduler') as scheduler:
+            plugin.prof_init(None, None, 'willy220', None)
+            teammate = plugin.TeamStore(output + '/team.sqlite')
+            teammate.PushNode('LadyInRed351', 'firewall', (1100, False, False, None, None, None), 1.0)
+            teammate.Flush()
+            plugin.prof_pre_chat_message_display('darknet@cyberspace', '', node_info)
+            scheduler.reset_mock()
+            plugin.prof_on_shutdown()
+            scheduler.MarkDirty.assert_not_called()
+            self.assertNotIn('LadyInRed351', plugin.processors)
+            self.assertEqual([node for system, node, _, _ in teammate.Pull(0)[2]
+                              if system == 'ManInBlack'], ['firewall'])
+            stamps = plugin.LoadProcessor('ManInBlack').stamps
+            self.assertEqual(stamps['firewall'][0][0], 2209900)
+            self.assertGreater(stamps['firewall'][1], 0)
+            teammate.Close()
+
     def testIsCyberSpaceBot(self):
         self.assertTrue(plugin.IsCyberSpaceBot('raven@jabber.alice.digital'))
         self.assertTrue(plugin.IsCyberSpaceBot('darknet@cyberspace'))
         self.assertFalse(plugin.IsCyberSpaceBot('vasya@cyberspace'))
 
+    def testRenderSchedulerCoalescesUpdates(self):
+        rendered = []
+        release = threading.Event()
+        def render(name):
+            release.wait()
+            rendered.append(name)
+        scheduler = plugin.RenderScheduler(render, min_interval=0)
+        for _ in range(100):
+            scheduler.MarkDirty('ManInBlack')
+        scheduler.MarkDirty('LadyInRed351')
+        release.set()
+        scheduler.Stop()
+        self.assertLessEqual(rendered.count('ManInBlack'), 2)
+        self.assertEqual(rendered.count('LadyInRed351'), 1)
+
+    def testRenderSchedulerFlushIgnoresMinInterval(self):
+        rendered = []
+        scheduler = plugin.RenderScheduler(rendered.append, min_interval=3600)
+        scheduler.MarkDirty('ManInBlack')
+        scheduler.Flush()
+        scheduler.MarkDirty('ManInBlack')
+        scheduler.Flush()
+        scheduler.Stop()
+        self.assertEqual(rendered, ['ManInBlack', 'ManInBlack'])
+
+    def testRenderSchedulerRespectsMinInterval(self):
+        rendered = []
+        scheduler = plugin.RenderScheduler(rendered.append, min_interval=3600)
+        scheduler.MarkDirty('ManInBlack')
+        scheduler.Flush()
+        scheduler.MarkDirty('ManInBlack')
+        self.assertFalse(threading.Event().wait(0.1))
+        self.assertEqual(rendered, ['ManInBlack'])
+        scheduler.Stop()
+        self.assertEqual(rendered, ['ManInBlack', 'ManInBlack'])
+
+    def testRenderSchedulerLogsFailuresOnClientThread(self):
+        logged = []
+        def log_warning(message):
+            logged.append((message, threading.current_thread() is threading.main_thread()))
+        def render(name):
+            raise RuntimeError('dot crashed')
+        with mock.patch.object(plugin, 'queued_warnings', deque()), \
+             mock.patch.object(plugin.prof, 'log_warning', log_warning):
+            scheduler = plugin.RenderScheduler(render, min_interval=0)
+            scheduler.MarkDirty('ManInBlack')
+            scheduler.Flush()
+            scheduler.Stop()
+            self.assertEqual(logged, [])
+            plugin.WarningsTick()
+        self.assertEqual(logged, [('Failed to render ManInBlack: dot crashed', True)])
+
+    def testDisplayHookDoesNotRender(self):
+        with mock.patch.object(plugin, 'render_scheduler') as scheduler, \
+             mock.patch.object(plugin.PerSystemProcessor, 'PrintToPdf') as print_to_pdf:
+            plugin.prof_pre_chat_message_send('darknet@cyberspace', 'target ManInBlack')
+            plugin.prof_pre_chat_message_display('darknet@cyberspace', '', 'ok')
+            scheduler.MarkDirty.assert_called_with('ManInBlack')
+            print_to_pdf.assert_not_called()
+
 if __name__ == '__main__':
     unittest.main()